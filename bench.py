@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+import numpy as np
+from gridworld import GridWorld
+from mdp import MDP, DIRECT_SOLVE_DENSE_MAX_STATES
+
+# every case is timed in one run and has its peak memory measured in a
+# second one, since tracemalloc slows down the python-level loops it
+# traces. each case returns a dict of extra measurements (sweeps,
+# backups, ...) alongside the wall time and peak memory added here
+
+def run_sweeps(iterator, args):
+    # advance a solver until its residual drops below the tolerance, or
+    # until it runs out of sweeps or time
+    start = perf_counter()
+    sweeps = 0
+    epsilon = None
+    for result in iterator:
+        sweeps += 1
+        epsilon = float(result[-1])
+        if (epsilon < args.tol or sweeps >= args.max_sweeps or
+                perf_counter() - start > args.max_seconds):
+            break
+    return {'sweeps': sweeps, 'residual': epsilon,
+            'converged': epsilon is not None and epsilon < args.tol}
+
+def case_build(gw, args):
+    GridWorld(gw.w, gw.h, [0], gamma=gw.gamma, dtype=gw.dtype)
+    return {}
+
+def case_validate(gw, args):
+    MDP(gw.P, gw.R, gw.gamma)
+    return {}
+
+def case_value_iteration(gw, args):
+    result = run_sweeps(gw.mdp.value_iteration(), args)
+    result['backups'] = (result['sweeps'] *
+                         gw.mdp.non_terminal_states.size * gw.n_actions)
+    return result
+
+def case_multigrid(gw, args):
+    # `sweeps` counts those of the full grid only, the coarser levels
+    # are far cheaper
+    _, _, stats = gw.solve('vi', mode='multigrid', tol=args.tol,
+                           max_iter=args.max_sweeps,
+                           time_budget=args.max_seconds, trace_memory=False)
+    return {'sweeps': stats.iterations,
+            'residual': stats.residuals[-1] if stats.residuals else None,
+            'converged': stats.converged,
+            'coarse_sweeps': sum(sweeps for _, _, sweeps
+                                 in stats.coarse_levels),
+            'backups': stats.backups}
+
+def case_policy_iteration(gw, args):
+    # a fresh MDP, so that no cached factorization is reused
+    mdp = MDP(gw.P, gw.R, gw.gamma)
+    result = run_sweeps(mdp.policy_iteration(), args)
+    result['backups'] = (result['sweeps'] *
+                         mdp.non_terminal_states.size * gw.n_actions)
+    return result
+
+def case_evaluate_solve(gw, args):
+    if gw.mdp.non_terminal_states.size > DIRECT_SOLVE_DENSE_MAX_STATES:
+        return {'skipped': 'too many states for a direct solve'}
+    # a fresh MDP, so that no cached factorization is reused
+    mdp = MDP(gw.P, gw.R, gw.gamma)
+    next(mdp.evaluate_policy(method='solve'))
+    return {}
+
+def case_evaluate_iter(gw, args):
+    result = run_sweeps(gw.mdp.evaluate_policy(method='iter'), args)
+    result['backups'] = result['sweeps'] * gw.mdp.non_terminal_states.size
+    return result
+
+def case_sample(gw, args):
+    # episodes follow the shortest-path policy, since random walks on
+    # large grids take far too long to reach the terminal state
+    policy = optimal_policy(gw, args)
+    np.random.seed(args.seed)
+    steps = 0
+    for _ in range(args.episodes):
+        steps += len(gw.mdp.sample(policy)[1])
+    return {'episodes': args.episodes, 'steps': steps}
+
+def case_sample_batch(gw, args):
+    policy = optimal_policy(gw, args)
+    _, lengths = gw.mdp.sample_batch(args.batch_episodes, policy,
+                                     rng=args.seed)
+    return {'episodes': args.batch_episodes, 'steps': int(lengths.sum())}
+
+CASES = {
+    'build': case_build,
+    'validate': case_validate,
+    'value_iteration': case_value_iteration,
+    'multigrid': case_multigrid,
+    'policy_iteration': case_policy_iteration,
+    'evaluate_solve': case_evaluate_solve,
+    'evaluate_iter': case_evaluate_iter,
+    'sample': case_sample,
+    'sample_batch': case_sample_batch,
+}
+
+_policies = {}
+
+def optimal_policy(gw, args):
+    # solved without discounting: with gamma < 1 the values far from
+    # the terminal state all round to the same number and the greedy
+    # policy there degenerates into a random walk
+    key = (gw.w, gw.h)
+    if key not in _policies:
+        mdp = MDP(gw.P, gw.R, 1)
+        v = None
+        for v, epsilon in mdp.value_iteration():
+            if epsilon < args.tol:
+                break
+        _policies[key] = mdp.greedy_policy(v)
+    return _policies[key]
+
+def run_case(name, gw, args):
+    fn = CASES[name]
+    times = []
+    for _ in range(args.repeat):
+        start = perf_counter()
+        result = fn(gw, args)
+        times.append(perf_counter() - start)
+    if 'skipped' in result:
+        return result
+
+    tracemalloc.start()
+    fn(gw, args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result['wall_time'] = min(times)
+    result['peak_memory'] = peak
+    for unit in ('backups', 'steps'):
+        if unit in result:
+            result[unit + '_per_sec'] = result[unit] / result['wall_time']
+    return result
+
+def git_commit():
+    try:
+        # the commit of this checkout, wherever the benchmark is run from
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    results = []
+    for size in args.sizes:
+        for gamma in args.gammas:
+            gw = GridWorld(size, size, [0], gamma=gamma, dtype=args.dtype)
+            for name in args.cases:
+                result = run_case(name, gw, args)
+                result.update(case=name, size=size, gamma=gamma)
+                results.append(result)
+                print(format_result(result), file=sys.stderr)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'settings': {k: v for k, v in vars(args).items()
+                     if k not in ('out', 'compare')},
+        'results': results,
+    }
+
+def format_result(result):
+    name = '{case} {size}x{size} gamma={gamma}'.format(**result)
+    if 'skipped' in result:
+        return '{:40} skipped ({})'.format(name, result['skipped'])
+    line = '{:40} {:10.4f}s {:8.1f}MiB'.format(
+        name, result['wall_time'], result['peak_memory'] / 2**20)
+    if 'sweeps' in result:
+        line += ' {:6d} sweeps'.format(result['sweeps'])
+        if not result['converged']:
+            line += ' (not converged)'
+    return line
+
+def compare(old, new, threshold):
+    # report cases that got slower by more than `threshold` times
+    key = lambda r: (r['case'], r['size'], r['gamma'])
+    old_times = {key(r): r['wall_time'] for r in old['results']
+                 if 'wall_time' in r}
+    regressions = []
+    for r in new['results']:
+        if 'wall_time' in r and key(r) in old_times:
+            ratio = r['wall_time'] / old_times[key(r)]
+            if ratio > threshold:
+                regressions.append((key(r), ratio))
+    for (case, size, gamma), ratio in regressions:
+        print('regression: {} {}x{} gamma={} is {:.2f}x slower'.format(
+            case, size, size, gamma, ratio), file=sys.stderr)
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='time GridWorld model building, solvers and sampling')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[4, 16, 64, 200])
+    parser.add_argument('--gammas', type=float, nargs='+',
+                        default=[0.9, 1.0])
+    parser.add_argument('--cases', nargs='+', choices=list(CASES),
+                        default=list(CASES))
+    parser.add_argument('--dtype', choices=('float64', 'float32'),
+                        default='float64')
+    parser.add_argument('--tol', type=float, default=1e-6)
+    parser.add_argument('--max-sweeps', type=int, default=10000)
+    parser.add_argument('--max-seconds', type=float, default=30,
+                        help='time limit for each iterative solve')
+    parser.add_argument('--episodes', type=int, default=100)
+    parser.add_argument('--batch-episodes', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the results as JSON here')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='earlier results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='slowdown ratio reported as a regression')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    np.random.seed(args.seed)
+    report = run(args)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), report, args.threshold):
+                sys.exit(1)
@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+import sys
+from queue import Queue
+from threading import Thread
+import numpy as np
+from gridworld import GridWorld
+from render import (GridLayout, Snapshot, frozen, render_policy,
+                    render_rewards, render_values, to_ppm)
+
+# headless export of solver progress. frames are handed to a writer
+# thread through a bounded queue, and rendering as well as disk I/O
+# happen there, so the solver only pays for copying its arrays. the
+# queue only blocks the solver if the writer falls far behind
+
+# 'ppm' writes one image per view and iteration using the same layout
+# and renderers as the viewer. 'array' appends the raw data of every
+# iteration to flat binary files, read back with `load_frames`
+FORMATS = ('ppm', 'array')
+
+class FrameWriter(object):
+    def __init__(self, gw, directory, format='ppm', max_w=None, max_h=None,
+                 queue_size=64):
+        if format not in FORMATS:
+            raise ValueError('format must be one of "ppm", "array"')
+        self.gw = gw
+        self.directory = directory
+        self.format = format
+        layout_args = {name: size for name, size in
+                       (('max_w', max_w), ('max_h', max_h))
+                       if size is not None}
+        self.layout = GridLayout(gw.w, gw.h, **layout_args)
+        self.terminal_mask = gw.mdp.terminal_mask.copy()
+        self.rewards = frozen(gw.R)
+
+        self.iterations = []
+        self.epsilons = []
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+        self._open_files()
+
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, snapshot):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(snapshot)
+
+    def close(self):
+        # wait for every queued frame to be written
+        self.queue.put(None)
+        self.thread.join()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self._write_metadata()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                return
+            if self.error is not None:
+                # keep draining so that the solver never blocks
+                continue
+            try:
+                self._write_frame(snapshot)
+            except Exception as e:
+                self.error = e
+
+    def _open_files(self):
+        self.files = {}
+        if self.format == 'array':
+            for name in ('values.f32', 'policy.u8'):
+                self.files[name] = open(self._path(name), 'wb')
+            np.asarray(self.rewards, dtype=np.float32).tofile(
+                self._path('rewards.f32'))
+        else:
+            self._write_image('rewards.ppm', render_rewards(
+                self.layout, self.rewards, self.terminal_mask))
+
+    def _write_frame(self, snapshot):
+        policy = snapshot.policy
+        if policy is None:
+            policy = self.gw.mdp.greedy_policy(snapshot.values)
+
+        if self.format == 'array':
+            values = np.asarray(snapshot.values, dtype=np.float32)
+            self.files['values.f32'].write(values.tobytes())
+            self.files['policy.u8'].write(pack_policy(policy).tobytes())
+        else:
+            name = '{}_{:05d}.ppm'
+            self._write_image(name.format('values', snapshot.iteration),
+                              render_values(self.layout, snapshot.values,
+                                            self.terminal_mask))
+            self._write_image(name.format('policy', snapshot.iteration),
+                              render_policy(self.layout, policy,
+                                            self.terminal_mask))
+        self.iterations.append(snapshot.iteration)
+        self.epsilons.append(float(snapshot.epsilon))
+
+    def _write_image(self, name, image):
+        with open(self._path(name), 'wb') as f:
+            f.write(to_ppm(image))
+
+    def _write_metadata(self):
+        metadata = {
+            'format': self.format,
+            'w': self.gw.w,
+            'h': self.gw.h,
+            'n_actions': self.gw.n_actions,
+            'terminal_states': sorted(int(s) for s in
+                                      np.flatnonzero(self.terminal_mask)),
+            'iterations': self.iterations,
+            'epsilons': self.epsilons,
+        }
+        with open(self._path('frames.json'), 'w') as f:
+            json.dump(metadata, f)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+
+def pack_policy(policy):
+    # one byte per state with bit `a` set if action `a` is most likely
+    best = policy == np.max(policy, axis=1, keepdims=True)
+    return np.matmul(best, 1 << np.arange(policy.shape[1])).astype(np.uint8)
+
+def load_frames(directory):
+    # read back an 'array' export. values and policy are memory-mapped
+    # `n_frames`*`n_states` arrays; bit `a` of a policy entry is set if
+    # action `a` is among the best
+    with open(os.path.join(directory, 'frames.json')) as f:
+        metadata = json.load(f)
+    if metadata['format'] != 'array':
+        raise ValueError('frames were not exported in the array format')
+
+    n_frames = len(metadata['iterations'])
+    n_states = metadata['w'] * metadata['h']
+    path = lambda name: os.path.join(directory, name)
+    load = lambda name, dtype, shape: (
+        np.memmap(path(name), dtype=dtype, mode='r', shape=shape)
+        if n_frames > 0 else np.zeros(shape, dtype=dtype))
+    metadata['values'] = load('values.f32', np.float32, (n_frames, n_states))
+    metadata['policy'] = load('policy.u8', np.uint8, (n_frames, n_states))
+    metadata['rewards'] = np.fromfile(path('rewards.f32'), dtype=np.float32) \
+                            .reshape(n_states, metadata['n_actions'])
+    return metadata
+
+def export_frames(gw, directory, method='vi', format='ppm', max_iter=1000,
+                  **writer_args):
+    # run value or policy iteration on `gw` until it converges or
+    # `max_iter` iterations are done, writing a frame for every one. the
+    # solve always starts from scratch rather than from the last solution
+    if method not in ('vi', 'pi'):
+        raise ValueError('method must be one of "vi", "pi"')
+
+    def write(iteration, values, policy, epsilon):
+        writer.write(Snapshot(iteration, frozen(values),
+                              None if policy is None else frozen(policy),
+                              epsilon))
+
+    with FrameWriter(gw, directory, format, **writer_args) as writer:
+        gw.solve(method, mode='sync', max_iter=max_iter, callback=write,
+                 trace_memory=False, v=None, policy=None)
+    return writer
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='write the progress of a GridWorld solver to disk')
+    parser.add_argument('method', choices=('vi', 'pi'))
+    parser.add_argument('w', type=int)
+    parser.add_argument('h', type=int)
+    parser.add_argument('directory')
+    parser.add_argument('--format', choices=FORMATS, default='ppm')
+    parser.add_argument('--terminal-states', type=int, nargs='+',
+                        default=[0])
+    parser.add_argument('--gamma', type=float, default=1)
+    parser.add_argument('--max-iter', type=int, default=1000)
+    parser.add_argument('--max-w', type=int)
+    parser.add_argument('--max-h', type=int)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    gw = GridWorld(args.w, args.h, args.terminal_states, gamma=args.gamma)
+    writer = export_frames(gw, args.directory, args.method, args.format,
+                           args.max_iter, max_w=args.max_w, max_h=args.max_h)
+    print('wrote {} frames to {}'.format(len(writer.iterations),
+                                         args.directory))
@@ -1,15 +1,44 @@
+import os
 import numpy as np
-from mdp import MDP
+from mdp import MDP, prob_tolerance
+from transitions import DeterministicTransitions, as_transitions, index_dtype
+
+# a model is refused if it would take up more than this fraction of the
+# physical memory, unless a `memory_limit` is given
+MEMORY_FRACTION = 0.5
+
+# 'multigrid' solves stop halving the grid once it has at most this many
+# states, and improve the policy interpolated onto each finer level at
+# most this many times
+MULTIGRID_MIN_STATES = 256
+MULTIGRID_IMPROVEMENTS = 6
 
 class GridWorld(object):
-    def __init__(self, w, h, terminal_states):
+    def __init__(self, w, h, terminal_states, sparse=True, gamma=1,
+                 dtype=np.float64, memory_limit=None):
+        # with `sparse` the transition model is stored as a successor
+        # table (see `DeterministicTransitions`), with probabilities
+        # only for states given stochastic transitions; the dense
+        # `n_actions`*`n_states`*`n_states` array is only practical for
+        # tiny grids
+
+        # `dtype` is used for rewards, probabilities and the values
+        # computed from them; float32 halves the memory used. before a
+        # model is built its size is estimated, and if it is more than
+        # `memory_limit` bytes a dense model is built as a sparse one
+        # instead, or the model is refused if that is too large as well
         self.n_actions = 4
+        self.sparse = sparse
+        self.gamma = gamma
+        self.dtype = np.dtype(dtype)
+        if not np.issubdtype(self.dtype, np.floating):
+            raise ValueError('dtype must be a floating point type')
+        self.memory_limit = memory_limit
 
         if len(terminal_states) < 1:
             raise ValueError('there must be at least 1 terminal state')
-        self.terminal_states = terminal_states
 
-        self.set_wh(w, h)
+        self._resize(w, h, set(terminal_states))
 
     def set_w(self, w):
         self.set_wh(w, self.h)
@@ -18,12 +47,22 @@ class GridWorld(object):
         self.set_wh(self.w, h)
 
     def set_wh(self, w, h):
-        self.terminal_states = [0]
-        self.w, self.h = w, h
-        self.n_states = w*h
+        # state numbers change meaning with the dimensions, so only
+        # state 0 is kept as a terminal state
+        self._resize(w, h, {0})
 
-        self._build_all()
-        self._build_MDP()
+    def estimate_memory(self, w, h, sparse=None):
+        # bytes taken up by the model of a `w`*`h` grid and by the arrays
+        # of one synchronous sweep over it (values, Q-values, rewards)
+        n_states = w * h
+        entries = self.n_actions * n_states
+        if sparse is None:
+            sparse = self.sparse
+        if sparse:
+            model = entries * np.dtype(index_dtype(n_states)).itemsize
+        else:
+            model = entries * n_states * self.dtype.itemsize
+        return model + 3 * entries * self.dtype.itemsize
 
     def set_transition_probs(self, s, P_s_a, a=None):
         # `P_s_a` is a `n_states` vector representing the probability
@@ -41,10 +80,11 @@ class GridWorld(object):
 
         if a == None:
             for a in range(self.n_actions):
-                self.P[a,s] = P_s_a
+                self._model.set_row((a,s), P_s_a)
         else:
-            for i, s_ in enumerate(S_):
-                self.P[a,s] = P_s_a
+            self._model.set_row((a,s), P_s_a)
+        self.mdp.refresh_terminal_states([s])
+        self.changed_states.add(s)
 
     def set_reward(self, s, r, a=None):
         # if action is None, set reward as `r` for all actions in state `s`
@@ -55,19 +95,119 @@ class GridWorld(object):
             self.R[s].fill(r)
         else:
             self.R[s,a] = r
+        self.changed_states.add(s)
 
     def toggle_terminal_state(self, s):
         if s in self.terminal_states:
-            self.terminal_states.remove(s)
-            if len(self.terminal_states) < 1:
+            if len(self.terminal_states) <= 1:
                 raise ValueError('there must be at least 1 terminal state')
+            self.terminal_states.remove(s)
             self._build_state(s, terminal=False, default=True)
         else:
-            self.terminal_states.append(s)
-            for a in range(4):
-                self.P[a,s].fill(0)
-                self.P[a,s,s] = 1
-            self.R[s].fill(0)
+            self.terminal_states.add(s)
+            self._build_state(s, terminal=True)
+        self.mdp.refresh_terminal_states([s])
+        self.changed_states.add(s)
+
+    def value_iteration(self, mode=None):
+        # like `MDP.value_iteration`, but re-solves start from the last
+        # solution and, by default, only back up states affected by the
+        # edits made since if that solution had converged
+        seeds = self._seed_states(self.last_values)
+        if mode is None:
+            mode = 'sync' if seeds is None else 'prioritized'
+        changed_states = set(self.changed_states)
+        for v, epsilon in self.mdp.value_iteration(mode, self.last_values,
+                                                   seeds):
+            self._record_solution(v, None, epsilon, changed_states)
+            yield v, epsilon
+
+    def policy_iteration(self, sweeps=None):
+        # like `MDP.policy_iteration`, starting from the last solution
+        changed_states = set(self.changed_states)
+        policy = self._warm_policy(changed_states)
+        for v, policy, epsilon in self.mdp.policy_iteration(
+                policy, self.last_values, sweeps):
+            self._record_solution(v, policy, epsilon, changed_states)
+            yield v, policy, epsilon
+
+    def solve(self, method='vi', mode=None, **solve_args):
+        # `MDP.solve`, warm-started from the last solution like
+        # `value_iteration` and `policy_iteration`. the result of 'vi' and
+        # 'pi' is recorded as the new last solution. 'vi' also takes the
+        # mode 'multigrid', which instead starts synchronous value
+        # iteration from `multigrid_start`; the coarser levels solved for
+        # that are listed in the `coarse_levels` of the stats
+        if method == 'eval':
+            return self.mdp.solve(method, **solve_args)
+
+        changed_states = set(self.changed_states)
+        solve_args.setdefault('v', self.last_values)
+        levels = []
+        if method == 'vi':
+            if mode == 'multigrid':
+                solve_args['v'], levels = self.multigrid_start(
+                    solve_args.get('tol', 0), solve_args.get('max_iter'))
+                mode = 'sync'
+            seeds = self._seed_states(solve_args['v'])
+            if mode is None:
+                mode = 'sync' if seeds is None else 'prioritized'
+            solve_args.update(mode=mode, changed_states=seeds)
+        elif method == 'pi':
+            if 'policy' not in solve_args:
+                solve_args['policy'] = self._warm_policy(changed_states)
+
+        v, policy, stats = self.mdp.solve(method, **solve_args)
+        stats.coarse_levels = levels
+        if stats.residuals:
+            self._record_solution(v, policy if method == 'pi' else None,
+                                  stats.residuals[-1], changed_states)
+        return v, policy, stats
+
+    def multigrid_start(self, tol=0, max_iter=None):
+        # initial values for value iteration on this grid, interpolated
+        # from the values of a grid of half the width and height (see
+        # `_coarsen`). those are found by synchronous value iteration to
+        # a residual of `tol` (or `max_iter` sweeps), itself started the
+        # same way, down to a grid of at most `MULTIGRID_MIN_STATES`
+        # states, so that every level only has to correct its start
+        # locally rather than carry values across the whole grid.
+        # returns the values (None if this grid is small enough to start
+        # from zeros) and the width, height and sweeps of every coarser
+        # level solved, coarsest first
+        if self.n_states <= MULTIGRID_MIN_STATES:
+            return None, []
+        coarse = self._coarsen()
+        v, levels = coarse.multigrid_start(tol, max_iter)
+        v, _, stats = coarse.mdp.solve('vi', tol=tol, max_iter=max_iter, v=v,
+                                       trace_memory=False)
+        levels.append((coarse.w, coarse.h, stats.iterations))
+        v = interpolate_blocks(v.reshape(coarse.h, coarse.w), self.h, 0)
+        v = interpolate_blocks(v, self.w, 1)
+        # the interpolated values are only right to within about a cell,
+        # and value iteration takes as many sweeps to remove an error
+        # spread over the grid as to solve from zeros. the values of
+        # their greedy policy are exact wherever it is optimal, and a few
+        # cheap rounds of policy improvement leave few states that are not
+        v = self.mdp._initial_values(v.reshape(-1))
+        actions = None
+        for _ in range(MULTIGRID_IMPROVEMENTS):
+            greedy = np.argmax(self.mdp.greedy_policy(v), axis=1)
+            if np.array_equal(greedy, actions):
+                break
+            actions = greedy
+            v = self.mdp._chain_values(actions, v)
+        return v, levels
+
+    def use_solution(self, v, policy):
+        # take `v` and `policy` as the converged solution of the current
+        # model, e.g. when it was solved before
+        self._record_solution(np.array(v), np.array(policy), 0,
+                              set(self.changed_states))
+
+    def is_solved(self):
+        # whether the last solution converged and no edits were made since
+        return self.last_epsilon == 0 and not self.changed_states
 
     def pretty_print_values(self, v):
         for i in range(self.h):
@@ -88,6 +228,83 @@ class GridWorld(object):
                           end=' ')
             print()
 
+    def _resize(self, w, h, terminal_states):
+        # nothing is changed if the new dimensions are refused
+        if any(s < 0 or s >= w*h for s in terminal_states):
+            raise ValueError('terminal states must be valid states')
+        self.sparse = self._choose_representation(w, h)
+        self.w, self.h = w, h
+        self.n_states = w*h
+        self.terminal_states = terminal_states
+
+        # the last solution found by `value_iteration` or
+        # `policy_iteration`, and the states edited since it converged
+        self.last_values = None
+        self.last_policy = None
+        self.last_epsilon = None
+        self.changed_states = set()
+
+        self._build_all()
+        self._build_MDP()
+
+    def _choose_representation(self, w, h):
+        # whether the model of a `w`*`h` grid is to be sparse
+        limit = self.memory_limit
+        if limit is None:
+            limit = physical_memory()
+            if limit is None:
+                return self.sparse
+            limit *= MEMORY_FRACTION
+        if self.estimate_memory(w, h) <= limit:
+            return self.sparse
+        if not self.sparse and self.estimate_memory(w, h, True) <= limit:
+            return True
+        raise ValueError(('a {}x{} grid needs about {:.0f}MiB, more than ' +
+                          'the memory limit of {:.0f}MiB').format(
+                              w, h, self.estimate_memory(w, h, True) / 2**20,
+                              limit / 2**20))
+
+    def _record_solution(self, v, policy, epsilon, changed_states):
+        self.last_values = v.copy()
+        if policy is not None:
+            self.last_policy = policy.copy()
+        self.last_epsilon = epsilon
+        if epsilon == 0:
+            # the edits made before this solve are now accounted for
+            self.changed_states -= changed_states
+
+    def _seed_states(self, v):
+        # the states 'prioritized' value iteration from `v` has to start
+        # from, or None if it has to look at every state. only the last
+        # solution, and only if it converged, is a fixed point apart
+        # from the states edited since
+        if (v is None or v is not self.last_values or
+                self.last_epsilon != 0):
+            return None
+        return set(self.changed_states)
+
+    def _warm_policy(self, changed_states):
+        # a copy of the last policy to start policy iteration from. edits
+        # can leave states whose actions no longer lead to a terminal
+        # state, e.g. towards a state that stopped being terminal, and
+        # with gamma=1 such a policy has no values to evaluate. those
+        # states are put back to the random policy, from which they can
+        # reach the rest of the grid again
+        if self.last_policy is None:
+            return None
+        policy = self.last_policy.copy()
+        if not changed_states or self.gamma < 1:
+            return policy
+        P_pi = as_transitions(self.mdp._get_P_pi(policy))
+        reaches = self.mdp.terminal_mask.copy()
+        while True:
+            new_reaches = reaches | (P_pi.dot(reaches.astype(self.dtype)) > 0)
+            if np.array_equal(new_reaches, reaches):
+                break
+            reaches = new_reaches
+        policy[~reaches] = 1/self.n_actions
+        return policy
+
     def _next_state(self, a, s):
         return (s if self.no_offset_map[a](s) else s + self.offset_map[a])
 
@@ -105,35 +322,49 @@ class GridWorld(object):
         # action
 
         if terminal:
-            for a in range(4):
-                self.P[a,s].fill(0)
-                self.P[a,s,s] = 1
+            for a in range(self.n_actions):
+                self._model.set_successors((a,s), [s], [1])
             self.R[s].fill(0)
+        elif default:
+            next_states = self._default_state_transitions(s)
+            for a in range(self.n_actions):
+                self._model.set_successors((a,s), [next_states[a]], [1])
+            self.R[s].fill(-1)
         else:
-            if default:
-                R_s = np.full(4,-1)
-                P_s = self._default_state_transitions(s)
-
             for a in range(self.n_actions):
                 self._verify_probs(P_s[a])
-                self.P[a,s] = P_s[a]
+                self._model.set_row((a,s), P_s[a])
             self.R[s] = R_s
 
     def _build_all(self):
         # this must be called first on initialisation, or when
-        # dimension are changed
+        # dimension are changed. the whole model is built from index
+        # arithmetic at once rather than state by state
         self._build_offset_maps()
-        self.P = np.zeros((self.n_actions, self.n_states, self.n_states))
-        self.R = np.zeros((self.n_states, self.n_actions))
+        next_states = self._default_transition_table()
+        terminal_mask = np.zeros(self.n_states, dtype=bool)
+        terminal_mask[list(self.terminal_states)] = True
+        next_states[:,terminal_mask] = np.flatnonzero(terminal_mask)
+
+        if self.sparse:
+            self.P = DeterministicTransitions(
+                next_states.astype(index_dtype(self.n_states)),
+                dtype=self.dtype)
+        else:
+            self.P = np.zeros((self.n_actions, self.n_states, self.n_states),
+                              dtype=self.dtype)
+            actions, states = np.indices(next_states.shape)
+            self.P[actions,states,next_states] = 1
+        self._model = as_transitions(self.P)
 
-        for s in range(self.n_states):
-            if s in self.terminal_states:
-                self._build_state(s, terminal=True)
-            else:
-                self._build_state(s, terminal=False, default=True)
+        self.R = np.full((self.n_states, self.n_actions), -1,
+                         dtype=self.dtype)
+        self.R[terminal_mask] = 0
 
     def _build_MDP(self):
-        self.mdp = MDP(P=self.P, R=self.R, gamma=1)
+        # the MDP is handed the model rather than a plain array, so that
+        # it sees the edits made through `_model`
+        self.mdp = MDP(P=self._model, R=self.R, gamma=self.gamma)
 
     def _build_offset_maps(self):
         self.offset_map = {0: -1, 1: 1, 2: -self.w, 3: self.w}
@@ -144,12 +375,53 @@ class GridWorld(object):
                               2: lambda s: s < self.w,
                               3: lambda s: s >= self.w*(self.h-1)}
 
+    def _default_transition_table(self):
+        # `n_actions`*`n_states` array of the successor of every state
+        # under the default dynamics. the offset maps work on arrays of
+        # states as well as on single states
+        states = np.arange(self.n_states)
+        return np.array([np.where(self.no_offset_map[a](states), states,
+                                  states + self.offset_map[a])
+                         for a in range(self.n_actions)])
+
     def _default_state_transitions(self, s):
-        P_s = np.full((self.n_actions, self.n_states), 0)
-        for a in range(self.n_actions):
-            s_ = self._next_state(a, s)
-            P_s[a,s_] = 1
-        return P_s
+        # the default dynamics are deterministic, so only the successor
+        # of each action is returned
+        return [self._next_state(a, s) for a in range(self.n_actions)]
+
+    def _coarsen(self):
+        # a grid of half the width and height (rounded up), each cell of
+        # which stands for a 2x2 block of cells of this one. one step on
+        # it covers two steps here, so it is discounted by gamma**2 and
+        # its rewards are those of two steps, averaged over the
+        # non-terminal cells of the block. a block with a terminal state
+        # in it is terminal. edited transition probabilities are not
+        # carried over, so the coarse grid only approximates this one
+        w, h = -(-self.w // 2), -(-self.h // 2)
+        terminal = self._blocks(self.mdp.terminal_mask, False)
+        # cells beyond the edges of the grid are left out like terminal ones
+        counted = ~self._blocks(self.mdp.terminal_mask, True)
+        R = np.sum(self._blocks(self.R, 0) * counted[..., np.newaxis],
+                   axis=(1,3))
+        R *= (1 + self.gamma) / np.maximum(counted.sum(axis=(1,3)),
+                                           1)[..., np.newaxis]
+
+        terminal = terminal.any(axis=(1,3)).reshape(-1)
+        coarse = GridWorld(w, h, set(np.flatnonzero(terminal).tolist()),
+                           gamma=self.gamma**2, dtype=self.dtype,
+                           memory_limit=self.memory_limit)
+        coarse.R[:] = R.reshape(coarse.R.shape)
+        coarse.R[terminal] = 0
+        return coarse
+
+    def _blocks(self, a, fill):
+        # the per-state array `a` as `h`/2*2*`w`/2*2 blocks of cells
+        # (rounded up), padded with `fill` beyond the edges of the grid
+        a = a.reshape((self.h, self.w) + a.shape[1:])
+        pad = [(0, self.h % 2), (0, self.w % 2)] + [(0, 0)] * (a.ndim - 2)
+        a = np.pad(a, pad, constant_values=fill)
+        return a.reshape((a.shape[0] // 2, 2, a.shape[1] // 2, 2) +
+                         a.shape[2:])
 
     def _best_actions(self, policy_row):
         # np.argmax but able to return multiple values
@@ -158,5 +430,30 @@ class GridWorld(object):
         return best_actions
 
     def _verify_probs(self, probs):
-        if np.sum(probs) != 1:
+        if not np.isclose(np.sum(probs), 1, rtol=0,
+                          atol=prob_tolerance(self.dtype)):
             raise ValueError('sum of probabilities must be 1')
+
+
+def interpolate_blocks(a, n, axis):
+    # `a` holds a value for every block of two cells along `axis` (the
+    # last of which only has one cell if `n` is odd). the values are
+    # taken to be those of the block centres and linearly interpolated
+    # to all `n` cells, and held beyond the outermost centres
+    m = a.shape[axis]
+    if m == 1:
+        return np.repeat(a, n, axis=axis)
+    centres = (2 * np.arange(m) + np.minimum(2 * np.arange(m) + 1, n - 1)) / 2
+    cells = np.arange(n)
+    lo = np.clip(np.searchsorted(centres, cells, side='right') - 1, 0, m - 2)
+    t = np.clip((cells - centres[lo]) / (centres[lo+1] - centres[lo]), 0, 1)
+    t = t.reshape([n if d == axis else 1 for d in range(a.ndim)])
+    return (np.take(a, lo, axis=axis) * (1 - t) +
+            np.take(a, lo + 1, axis=axis) * t)
+
+def physical_memory():
+    # bytes of physical memory, or None where that is unknown
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
@@ -0,0 +1,207 @@
+import argparse
+import sys
+from collections import namedtuple
+from time import perf_counter
+import numpy as np
+from gridworld import GridWorld
+
+# sample-based learners, for checking the planners in `MDP` against.
+# `n_agents` independent agents step through the same MDP in lockstep:
+# every step draws the actions, successors and rewards of all agents
+# with a few array operations and applies all their TD updates to one
+# shared Q table at once. samples of the same state and action within a
+# step are averaged rather than applied one after another, so that many
+# agents in one state cannot overshoot its value
+
+ALGORITHMS = ('q-learning', 'sarsa')
+
+# one point of a learning curve. `mean_return` is the mean undiscounted
+# return of the episodes finished since the last point (None if there
+# were none). `value_error` is the largest difference between the learnt
+# and the reference values over the non-terminal states, and
+# `policy_agreement` the fraction of them whose greedy action is optimal
+# under the reference values (both None without reference values)
+LearningPoint = namedtuple('LearningPoint', [
+    'steps', 'episodes', 'mean_return', 'value_error', 'policy_agreement',
+    'steps_per_sec'])
+
+class TDLearner(object):
+    # `alpha` is the step size and `epsilon` the exploration rate of the
+    # epsilon-greedy behaviour policy. episodes end when a terminal
+    # state is reached, or are cut off after `max_episode_steps` steps;
+    # either way the agent starts again in a random non-terminal state.
+    # the transition model is read once, so the learner does not see
+    # edits made to the model afterwards
+    def __init__(self, mdp, algorithm='q-learning', n_agents=1000,
+                 alpha=0.1, epsilon=0.1, max_episode_steps=None, rng=None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError('algorithm must be one of "q-learning", ' +
+                             '"sarsa"')
+        if mdp.non_terminal_states.size == 0:
+            raise ValueError('there are no non-terminal states to start in')
+        self.mdp = mdp
+        self.algorithm = algorithm
+        self.n_agents = n_agents
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.max_episode_steps = (10 * mdp.n_states if max_episode_steps
+                                  is None else max_episode_steps)
+        self.rng = np.random.default_rng(rng)
+
+        self.Q = np.zeros((mdp.n_states, mdp.n_actions), dtype=mdp.dtype)
+        self.next_states, self.transition_cum = \
+            mdp._model.cumulative_table()
+        self.n_pairs = mdp.n_states * mdp.n_actions
+
+        self.steps = 0
+        self.episodes = 0
+        self.finished_returns = []
+        self.states = self.rng.choice(mdp.non_terminal_states, n_agents)
+        self.actions = self.choose_actions(self.states)
+        self.returns = np.zeros(n_agents)
+        self.lengths = np.zeros(n_agents, dtype=int)
+
+    def choose_actions(self, states):
+        # epsilon-greedy with respect to Q, breaking ties at random
+        q = self.Q[states]
+        best = q == q.max(axis=1, keepdims=True)
+        actions = np.argmax(best * self.rng.random(q.shape), axis=1)
+        explore = self.rng.random(states.size) < self.epsilon
+        actions[explore] = self.rng.integers(self.mdp.n_actions,
+                                             size=np.count_nonzero(explore))
+        return actions
+
+    def step(self):
+        # one environment step and TD update for every agent
+        states, actions = self.states, self.actions
+        rewards = self.mdp.R[states,actions]
+        if self.next_states.shape[-1] == 1:
+            next_states = self.next_states[actions,states,0]
+        else:
+            slots = self.mdp._draw(self.transition_cum[actions,states],
+                                   self.rng)
+            next_states = self.next_states[actions,states,slots]
+        next_actions = self.choose_actions(next_states)
+
+        done = self.mdp.terminal_mask[next_states]
+        if self.algorithm == 'q-learning':
+            next_q = self.Q[next_states].max(axis=1)
+        else:
+            next_q = self.Q[next_states,next_actions]
+        targets = rewards + self.mdp.gamma * np.where(done, 0, next_q)
+        errors = targets - self.Q[states,actions]
+
+        pairs = states * self.mdp.n_actions + actions
+        counts = np.bincount(pairs, minlength=self.n_pairs)
+        sums = np.bincount(pairs, weights=errors, minlength=self.n_pairs)
+        visited = counts > 0
+        self.Q.reshape(-1)[visited] += (self.alpha * sums[visited] /
+                                        counts[visited])
+
+        self.returns += rewards
+        self.lengths += 1
+        self.steps += self.n_agents
+        ended = done | (self.lengths >= self.max_episode_steps)
+        if ended.any():
+            # only episodes that reached a terminal state count as
+            # finished, cut off ones are just restarted
+            self.finished_returns.extend(self.returns[done].tolist())
+            self.episodes += int(np.count_nonzero(done))
+            n_ended = int(np.count_nonzero(ended))
+            next_states[ended] = self.rng.choice(
+                self.mdp.non_terminal_states, n_ended)
+            next_actions[ended] = self.choose_actions(next_states[ended])
+            self.returns[ended] = 0
+            self.lengths[ended] = 0
+        self.states, self.actions = next_states, next_actions
+
+    def values(self):
+        v = self.Q.max(axis=1)
+        v[self.mdp.terminal_mask] = 0
+        return v
+
+    def greedy_policy(self):
+        best = self.Q == self.Q.max(axis=1, keepdims=True)
+        return best / best.sum(axis=1, keepdims=True)
+
+    def learn(self, n_steps, report_every=None, reference=None):
+        # take at least `n_steps` environment steps (over all agents),
+        # yielding a `LearningPoint` about every `report_every` of them
+        # and once at the end. `reference` are values to compare the
+        # learnt ones with, e.g. from value iteration
+        if report_every is None:
+            report_every = n_steps
+        target = self.steps + n_steps
+        start = perf_counter()
+        start_steps = self.steps
+        next_report = self.steps + report_every
+        while self.steps < target:
+            self.step()
+            if self.steps >= next_report or self.steps >= target:
+                next_report = self.steps + report_every
+                yield self._report(reference, (self.steps - start_steps) /
+                                   max(perf_counter() - start, 1e-9))
+
+    def _report(self, reference, steps_per_sec):
+        mean_return = (float(np.mean(self.finished_returns))
+                       if self.finished_returns else None)
+        self.finished_returns = []
+        value_error = policy_agreement = None
+        if reference is not None:
+            value_error, policy_agreement = compare_with(self.mdp, self.Q,
+                                                         reference)
+        return LearningPoint(self.steps, self.episodes, mean_return,
+                             value_error, policy_agreement, steps_per_sec)
+
+
+def compare_with(mdp, Q, v, tol=1e-6):
+    # the largest difference between the values of `Q` and `v`, and the
+    # fraction of states whose greedy action under `Q` is within `tol`
+    # of the best under `v`, both over the non-terminal states
+    states = mdp.non_terminal_states
+    if states.size == 0:
+        return 0.0, 1.0
+    q = mdp._q_values(v)[states]
+    greedy = np.argmax(Q[states], axis=1)
+    optimal = q[np.arange(states.size),greedy] >= \
+              q.max(axis=1) - tol * (1 + np.abs(q.max(axis=1)))
+    value_error = np.max(np.abs(Q[states].max(axis=1) - v[states]))
+    return float(value_error), float(np.mean(optimal))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='learn a GridWorld with vectorized Q-learning or ' +
+                    'SARSA and compare against value iteration')
+    parser.add_argument('w', type=int)
+    parser.add_argument('h', type=int)
+    parser.add_argument('--algorithm', choices=ALGORITHMS,
+                        default='q-learning')
+    parser.add_argument('--terminal-states', type=int, nargs='+',
+                        default=[0])
+    parser.add_argument('--gamma', type=float, default=0.95)
+    parser.add_argument('--agents', type=int, default=10000)
+    parser.add_argument('--steps', type=int, default=10**7)
+    parser.add_argument('--report-every', type=int, default=10**6)
+    parser.add_argument('--alpha', type=float, default=0.1)
+    parser.add_argument('--epsilon', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    gw = GridWorld(args.w, args.h, args.terminal_states, gamma=args.gamma)
+    reference, _, stats = gw.mdp.solve('vi', tol=1e-10, trace_memory=False)
+    print('value iteration: {} sweeps in {:.4f}s'.format(stats.iterations,
+                                                        stats.wall_time))
+
+    learner = TDLearner(gw.mdp, args.algorithm, args.agents, args.alpha,
+                        args.epsilon, rng=args.seed)
+    print('{:>12} {:>10} {:>12} {:>12} {:>9} {:>12}'.format(
+        'steps', 'episodes', 'mean return', 'value error', 'optimal',
+        'steps/s'))
+    for point in learner.learn(args.steps, args.report_every, reference):
+        print('{:12d} {:10d} {:>12} {:12.4f} {:9.1%} {:12.0f}'.format(
+            point.steps, point.episodes,
+            '-' if point.mean_return is None
+            else '{:.2f}'.format(point.mean_return),
+            point.value_error, point.policy_agreement, point.steps_per_sec))
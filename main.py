@@ -1,10 +1,22 @@
+import json
+import sys
 from sys import argv
 from gridworld import GridWorld
-from viewer import *
+from mdp import MDP, SOLVE_METHODS
+from storage import SolutionCache, load_gridworld, save_gridworld
+try:
+    from viewer import *
+except ImportError:
+    # without tkinter, vi and pi solve headlessly
+    ValueIterationViewer = PolicyIterationViewer = None
 
 class GridWorldError(Exception): pass
 
 gw = None
+# solutions of models solved before, possibly in earlier sessions
+cache = None
+# when commands come from a file or a pipe, nothing opens a window
+headless = False
 
 def print_help():
     print('''
@@ -22,6 +34,16 @@ for state
 eval - run policy evaluation (for random policy)
 pi - run policy iteration
 vi - run value iteration
+(pi and vi print the solution right away if the model was solved before,
+and solve without a window when running headless)
+solve [<method>] [<tolerance>] [<file>] - solve with method vi, pi or eval
+without a window, and print the values, policy and timing (or write them
+to file as JSON)
+bench [<method>] [<repeats>] [<tolerance>] - time solving the grid world
+from scratch
+save <directory> - save the grid world and its last solution
+load <directory> - load a grid world saved with save
+q - quit
 ''')
 
 def get_arg(args, n, type, element_type=None):
@@ -66,19 +88,25 @@ def process_line(line):
         if w is None:
             print(gw.w)
         else:
-            gw.set_w(w)
+            try:
+                gw.set_w(w)
+            except ValueError as e:
+                raise GridWorldError(e)
 
     elif cmd == 'h':
         h = get_optional_arg(args, 0, int)
         if h is None:
             print(gw.h)
         else:
-            gw.set_h(h)
+            try:
+                gw.set_h(h)
+            except ValueError as e:
+                raise GridWorldError(e)
 
     elif cmd == 't':
         states = get_optional_arg(args, 0, list, int)
         if states == None:
-            print(gw.terminal_states)
+            print(sorted(gw.terminal_states))
         else:
             for s in states:
                 if s < 0 or s >= gw.n_states:
@@ -95,31 +123,188 @@ def process_line(line):
         actions = get_optional_arg(args, 2, list, int, default=(0,1,2,3))
 
         for s in states:
+            if s < 0 or s >= gw.n_states:
+                raise GridWorldError('invalid state number')
             for a in actions:
-                gw.set_reward(s, reward, a)
+                if a < 0 or a >= gw.n_actions:
+                    raise GridWorldError('invalid action number')
+                try:
+                    gw.set_reward(s, reward, a)
+                except ValueError as e:
+                    raise GridWorldError(e)
 
     elif cmd == 's':
         # TODO
         pass
 
-    elif cmd == 'vi':
-        ValueIterationViewer(gw).run()
+    elif cmd == 'eval':
+        run_solve('eval')
+
+    elif cmd in ('vi', 'pi'):
+        viewer = (ValueIterationViewer if cmd == 'vi'
+                  else PolicyIterationViewer)
+        if headless or viewer is None:
+            run_solve(cmd)
+        elif solve_from_cache():
+            print_solution(gw.last_values, gw.last_policy)
+        else:
+            viewer(gw).run()
+            cache_solution()
+
+    elif cmd == 'solve':
+        method = get_optional_arg(args, 0, str, default='vi')
+        tol = get_optional_arg(args, 1, float, default=0)
+        out = get_optional_arg(args, 2, str)
+        run_solve(method, tol, out)
+
+    elif cmd == 'bench':
+        method = get_optional_arg(args, 0, str, default='vi')
+        repeats = get_optional_arg(args, 1, int, default=3)
+        tol = get_optional_arg(args, 2, float, default=1e-6)
+        run_bench(method, repeats, tol)
 
-    elif cmd == 'pi':
-        PolicyIterationViewer(gw).run()
+    elif cmd == 'save':
+        directory = get_arg(args, 0, str)
+        try:
+            save_gridworld(gw, directory)
+        except OSError as e:
+            raise GridWorldError(e)
+
+    elif cmd == 'load':
+        directory = get_arg(args, 0, str)
+        try:
+            gw = load_gridworld(directory)
+        except (OSError, ValueError) as e:
+            raise GridWorldError(e)
 
     elif cmd == 'q':
-        exit()
+        sys.exit()
 
     else:
         raise GridWorldError('unknown command')
 
+def check_method(method):
+    if method not in SOLVE_METHODS:
+        raise GridWorldError('method must be one of ' +
+                             ', '.join(SOLVE_METHODS))
+
+def run_solve(method, tol=0, out=None):
+    check_method(method)
+    stats = None
+    if method == 'eval' or not solve_from_cache():
+        values, policy, stats = gw.solve(method, tol=tol)
+        cache_solution()
+    else:
+        values, policy = gw.last_values, gw.last_policy
+
+    if out is None:
+        print_solution(values, policy)
+        print('cached solution' if stats is None else format_stats(stats))
+        return
+
+    result = {
+        'w': gw.w,
+        'h': gw.h,
+        'method': method,
+        'values': values.tolist(),
+        'policy': policy.tolist(),
+        'cached': stats is None,
+        'stats': None if stats is None else stats.as_dict(),
+    }
+    try:
+        with open(out, 'w') as f:
+            json.dump(result, f)
+    except OSError as e:
+        raise GridWorldError(e)
+
+def run_bench(method, repeats, tol):
+    # every solve starts cold, on a fresh MDP without the last solution
+    # or cached factorizations. memory is measured in a separate run
+    check_method(method)
+    if repeats < 1:
+        raise GridWorldError('number of repeats must be at least 1')
+    runs = [MDP(gw.P, gw.R, gw.gamma).solve(method, tol=tol,
+                                            trace_memory=False)[2]
+            for _ in range(repeats)]
+    best = min(runs, key=lambda stats: stats.wall_time)
+    peak = MDP(gw.P, gw.R, gw.gamma).solve(method, tol=tol,
+                                           trace_memory=True)[2].peak_memory
+    print('{} {}x{}: best of {}: {}, {:.1f}MiB peak'.format(
+        method, gw.w, gw.h, repeats, format_stats(best), peak / 2**20))
+
+def format_stats(stats):
+    line = '{} iterations in {:.4f}s ({:.0f} backups/s)'.format(
+        stats.iterations, stats.wall_time, stats.backups_per_sec)
+    if not stats.converged:
+        line += ', not converged ({})'.format(stats.reason)
+    return line
+
+def print_solution(values, policy):
+    gw.pretty_print_values(values)
+    print()
+    gw.pretty_print_policy(policy)
+
+def solve_from_cache():
+    # use the cached solution of the current model, if there is one
+    hit = None if cache is None else cache.get(gw.mdp)
+    if hit is None:
+        return False
+    gw.use_solution(*hit)
+    return True
+
+def cache_solution():
+    # solvers stopped before they converged are not cached
+    if cache is not None and gw.is_solved():
+        cache.put(gw.mdp, gw.last_values,
+                  gw.mdp.greedy_policy(gw.last_values))
+
+def run_script(f):
+    # run every line of `f` as a command, reporting errors with their
+    # line number. returns the number of failed commands
+    failed = 0
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.split(' ')[0] == 'q':
+            # stop here, but still exit with the status of the commands
+            # run so far
+            break
+        try:
+            process_line(line)
+        except (GridWorldError, ValueError, IndexError) as e:
+            print('line {}: {}'.format(number, e), file=sys.stderr)
+            failed += 1
+    return failed
+
 if __name__ == '__main__':
+    # usage: main.py [<width> <height>] [<command file> | -]
+    # commands are read from the file, or from stdin if it is '-' or not
+    # a terminal, and run without opening any window
+    args = argv[1:]
     try:
-        w, h = int(argv[1]), int(argv[2])
+        w, h = int(args[0]), int(args[1])
+        args = args[2:]
     except (ValueError, IndexError):
         w = h = 4
     gw = GridWorld(w, h, [0])
+    try:
+        cache = SolutionCache()
+    except OSError as e:
+        print('solution cache disabled: {}'.format(e), file=sys.stderr)
+
+    if args or not sys.stdin.isatty():
+        headless = True
+        if not args or args[0] == '-':
+            failed = run_script(sys.stdin)
+        else:
+            try:
+                with open(args[0]) as f:
+                    failed = run_script(f)
+            except OSError as e:
+                print(e, file=sys.stderr)
+                sys.exit(2)
+        sys.exit(1 if failed else 0)
 
     while True:
         line = input('> ')
@@ -1,15 +1,106 @@
+import hashlib
+import heapq
+import tracemalloc
+from time import perf_counter
 import numpy as np
+from transitions import DeterministicTransitions, as_transitions
+
+# largest accepted deviation of a row of probabilities from summing to 1
+PROB_TOLERANCE = 1e-8
+# policy evaluation solves (I - gamma*P_pi) v = R_pi over the non-terminal
+# states directly up to this many states, and for somewhat larger models
+# if P_pi is dense enough that a sparse method would not be cheaper
+DIRECT_SOLVE_MAX_STATES = 1500
+DIRECT_SOLVE_DENSE_MAX_STATES = 4000
+DIRECT_SOLVE_MIN_DENSITY = 0.1
+# number of factorizations of I - gamma*P_pi kept per MDP
+FACTOR_CACHE_SIZE = 4
+# the krylov method stops once its residual is this small relative to the
+# norm of R_pi
+KRYLOV_TOLERANCE = 1e-10
+
+# policy iteration only switches a state to other actions if they are
+# better than the current ones by more than this, relative to the value
+POLICY_IMPROVEMENT_TOLERANCE = 1e-10
+
+# a backup from the priority queue costs far more than backing up the same
+# state in a vectorized sweep, so once a re-solve of 'prioritized' value
+# iteration from `changed_states` has done this fraction of a sweep's
+# backups, the edits are taken to affect too much of the model and it
+# carries on with synchronous sweeps
+PRIORITIZED_MAX_FRACTION = 1/64
+
+SOLVE_METHODS = ('vi', 'pi', 'eval')
+
+def prob_tolerance(dtype):
+    # probabilities stored with less precision than float64 are only
+    # accurate to a few units in the last place of `dtype`
+    if not np.issubdtype(dtype, np.floating):
+        return PROB_TOLERANCE
+    return max(PROB_TOLERANCE, 16 * float(np.finfo(dtype).eps))
+
+
+class SolveStats(object):
+    # what `MDP.solve` measured. `backups` counts the state-action
+    # backups a full synchronous sweep of the method would do (state
+    # backups for 'eval'), so the in-place value iteration modes, which
+    # may skip states, are credited with full sweeps. `peak_memory` is
+    # the largest amount of memory allocated during the solve, in bytes,
+    # or None if it was not traced
+    def __init__(self, method):
+        self.method = method
+        self.iterations = 0
+        self.residuals = []
+        self.sweep_times = []
+        self.backups = 0
+        self.wall_time = 0
+        self.peak_memory = None
+        self.converged = False
+        # why the solve stopped: 'converged', 'max_iter', 'time_budget',
+        # 'callback' or 'exhausted' if the solver itself finished
+        self.reason = None
+        # (w, h, iterations) of the coarser grids solved first to start
+        # a 'multigrid' solve of a `GridWorld` from
+        self.coarse_levels = []
+
+    @property
+    def backups_per_sec(self):
+        return self.backups / self.wall_time if self.wall_time > 0 else 0
+
+    def as_dict(self):
+        stats = dict(vars(self))
+        stats['residuals'] = [float(e) for e in self.residuals]
+        stats['backups_per_sec'] = self.backups_per_sec
+        return stats
+
+    def __repr__(self):
+        return ('SolveStats(method={!r}, iterations={}, residual={}, ' +
+                'reason={!r}, wall_time={:.4f}s, backups_per_sec={:.0f})') \
+               .format(self.method, self.iterations,
+                       self.residuals[-1] if self.residuals else None,
+                       self.reason, self.wall_time, self.backups_per_sec)
 
 class MDP(object):
     def __init__(self, P, R, gamma):
-        for P_a in P:
-            for row in P_a:
-                if row.sum() != 1:
-                    raise ValueError('state transition probabilities for ' +
-                                     'each state must add up to 1')
-
-        self.n_actions = P.shape[0]
-        self.n_states = P.shape[1]
+        # `P` is either a dense `n_actions`*`n_states`*`n_states` array
+        # or a transition model from `transitions`, such as a
+        # `SparseTransitions` table, which keeps memory at O(A*S*k) for
+        # models with at most k successors per state
+        self._model = as_transitions(P)
+        row_sums = self._model.row_sums()
+        self.prob_tolerance = prob_tolerance(row_sums.dtype)
+        if not np.allclose(row_sums, 1, rtol=0, atol=self.prob_tolerance):
+            raise ValueError('state transition probabilities for ' +
+                             'each state must add up to 1')
+        if isinstance(P, np.ndarray):
+            # nothing else edits a plain array through a model, so if
+            # every row is certain it is replaced by a successor table.
+            # models are used as given, since their owner may edit them
+            self._model = (DeterministicTransitions.detect(
+                P, self.prob_tolerance) or self._model)
+
+        self.n_actions = self._model.n_actions
+        self.n_states = self._model.n_states
         if R.shape[0] != self.n_states:
             raise ValueError('number of states in R and ' +
                              'P do not match')
@@ -17,15 +108,49 @@ class MDP(object):
         self.P = P
         self.R = R
         self.gamma = gamma
+        # values and policies are computed in the precision of the
+        # rewards, so float32 rewards halve the memory traffic of sweeps
+        self.dtype = (R.dtype if np.issubdtype(R.dtype, np.floating)
+                      else np.dtype(np.float64))
+        self._factor_cache = {}
+        self.refresh_terminal_states()
+
+    def refresh_terminal_states(self, states=None):
+        # a state is terminal if every action keeps it where it is.
+        # this has to be called for every state whose transitions are
+        # changed after construction
+        certain = 1 - self.prob_tolerance
+        if states is None:
+            self.terminal_mask = np.all(self._model.diagonal() >= certain,
+                                        axis=0)
+        else:
+            for s in states:
+                self.terminal_mask[s] = all(
+                    self._self_loop_prob(a, s) >= certain
+                    for a in range(self.n_actions))
+        self.non_terminal_states = np.flatnonzero(~self.terminal_mask)
+
+    def digest(self):
+        # a hash of the whole model, equal for MDPs with the same
+        # transitions (in the same representation), rewards and gamma
+        return self._digest(self.R, float(self.gamma), *self._model.arrays())
 
     def random_policy(self):
         probability = 1/self.n_actions
-        return np.full((self.n_states, self.n_actions), probability)
- 
+        return np.full((self.n_states, self.n_actions), probability,
+                       dtype=self.dtype)
+
+    def greedy_policy(self, v):
+        # the policy that is greedy with respect to `v`, choosing between
+        # equally good actions with equal probability
+        q = self._q_values(v)
+        best = q == q.max(axis=1, keepdims=True)
+        return (best / best.sum(axis=1, keepdims=True)).astype(self.dtype)
+
     def sample(self, policy=None, state=None):
-        if policy == None:
+        if policy is None:
             policy = self.random_policy()
-        if state == None:
+        if state is None:
             state = self._get_start_state()
         self._check_policy_probs(policy)
 
@@ -42,134 +167,733 @@ class MDP(object):
             state = new_state
         return fetch, samples
 
-    def evaluate_policy(self, policy=None, method=''):
-        if policy == None:
+    def sample_batch(self, n_episodes, policy=None, states=None, rng=None,
+                     max_steps=None):
+        # simulate `n_episodes` episodes in lockstep, with the same
+        # semantics as `sample`. `rng` is a `np.random.Generator` or a
+        # seed. returns the return and the number of transitions of each
+        # episode; episodes still running after `max_steps` steps are
+        # cut off there
+        if policy is None:
+            policy = self.random_policy()
+        self._check_policy_probs(policy)
+        rng = np.random.default_rng(rng)
+
+        if states is None:
+            if self.non_terminal_states.size == 0:
+                raise ValueError('there are no non-terminal states to ' +
+                                 'start in')
+            states = rng.choice(self.non_terminal_states, n_episodes)
+        else:
+            states = np.broadcast_to(states, n_episodes).copy()
+
+        # inverse transform sampling against cumulative tables: the
+        # sampled index is the number of entries below a uniform draw
+        policy_cum = np.cumsum(policy, axis=1)
+        next_states, transition_cum = self._model.cumulative_table()
+
+        returns = np.zeros(n_episodes)
+        lengths = np.zeros(n_episodes, dtype=int)
+        active = np.arange(n_episodes)
+        steps = 0
+        while active.size > 0 and (max_steps is None or steps < max_steps):
+            actions = self._draw(policy_cum[states], rng)
+            returns[active] += self.R[states,actions]
+
+            running = ~self.terminal_mask[states]
+            active = active[running]
+            states, actions = states[running], actions[running]
+            if next_states.shape[-1] == 1:
+                # deterministic transitions need no draw
+                states = next_states[actions,states,0]
+            else:
+                slots = self._draw(transition_cum[actions,states], rng)
+                states = next_states[actions,states,slots]
+            lengths[active] += 1
+            steps += 1
+        return returns, lengths
+
+    def solve(self, method='vi', tol=0, max_iter=None, time_budget=None,
+              callback=None, trace_memory=False, policy=None, v=None,
+              mode='sync', changed_states=None, eval_method='',
+              sweeps=None):
+        # run value iteration ('vi'), policy iteration ('pi') or policy
+        # evaluation ('eval') until the residual is at most `tol` (for
+        # 'pi', until the policy is also stable), `max_iter` iterations
+        # are done or `time_budget` seconds have passed. `policy`, `v`,
+        # `mode`, `changed_states`, `eval_method` and `sweeps` are passed
+        # on to the solver they apply to. returns the values, the policy
+        # (greedy with respect to the values for 'vi') and a `SolveStats`
+
+        # `callback(iteration, v, policy, epsilon)` is called after every
+        # iteration, with `policy` None for 'vi'. returning True from it
+        # stops the solve. `trace_memory` measures the peak memory, but
+        # tracemalloc slows the python-level loops down several times,
+        # so the times of such a solve are not representative
+        if method not in SOLVE_METHODS:
+            raise ValueError('method must be one of "vi", "pi", "eval"')
+        if method == 'vi':
+            solver = self.value_iteration(mode, v, changed_states)
+            sweep_backups = self.non_terminal_states.size * self.n_actions
+        elif method == 'pi':
+            solver = self.policy_iteration(
+                None if policy is None else np.array(policy, self.dtype), v,
+                sweeps)
+            sweep_backups = self.non_terminal_states.size * self.n_actions
+        else:
+            if policy is None:
+                policy = self.random_policy()
+            solver = self.evaluate_policy(policy, eval_method, v)
+            sweep_backups = self.non_terminal_states.size
+
+        stats = SolveStats(method)
+        tracing = trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif trace_memory:
+            tracemalloc.reset_peak()
+        base_memory = (tracemalloc.get_traced_memory()[0] if trace_memory
+                       else 0)
+
+        start = perf_counter()
+        values = last_policy = None
+        within_tolerance = False
+        try:
+            while True:
+                sweep_start = perf_counter()
+                try:
+                    result = next(solver)
+                except StopIteration as stop:
+                    # a solver that ends by itself may say that it got
+                    # within its own tolerance, which is as close as it
+                    # can get even if that is more than `tol`
+                    stats.reason = 'exhausted'
+                    within_tolerance = bool(stop.value)
+                    break
+                now = perf_counter()
+                stats.iterations += 1
+                stats.sweep_times.append(now - sweep_start)
+                stats.backups += sweep_backups
+
+                values, epsilon = result[0], result[-1]
+                stable = True
+                if method == 'pi':
+                    stable = (last_policy is not None and
+                              np.array_equal(result[1], last_policy))
+                    policy = last_policy = result[1].copy()
+                stats.residuals.append(float(epsilon))
+
+                stop = callback is not None and callback(
+                    stats.iterations, values,
+                    None if method == 'vi' else policy, epsilon)
+                if epsilon <= tol and stable:
+                    stats.reason = 'converged'
+                elif stop:
+                    stats.reason = 'callback'
+                elif max_iter is not None and stats.iterations >= max_iter:
+                    stats.reason = 'max_iter'
+                elif time_budget is not None and now - start >= time_budget:
+                    stats.reason = 'time_budget'
+                if stats.reason is not None:
+                    break
+        finally:
+            stats.wall_time = perf_counter() - start
+            if trace_memory:
+                stats.peak_memory = (tracemalloc.get_traced_memory()[1] -
+                                     base_memory)
+            if tracing:
+                tracemalloc.stop()
+
+        stats.converged = (bool(stats.residuals) and
+                           (stats.residuals[-1] <= tol or within_tolerance) and
+                           stats.reason in ('converged', 'exhausted'))
+        if values is None:
+            values = self._initial_values(v)
+        if method == 'vi':
+            policy = self.greedy_policy(values)
+        elif policy is None:
+            policy = self.random_policy()
+        return values, policy, stats
+
+    def evaluate_policy(self, policy=None, method='', v=None):
+        # 'solve' yields the exact values once, 'krylov' yields each
+        # iterate of BiCGSTAB until it converges and 'iter' yields
+        # synchronous backups forever. the iterative methods start from
+        # `v` if it is given. 'krylov' returns whether it ended within
+        # its own tolerance rather than by running out of iterations
+        if policy is None:
             policy = self.random_policy()
         if method == '':
-            method = ('solve' if self.n_states < 30 else 'iter')
+            method = self._choose_eval_method()
         self._check_policy_probs(policy)
 
+        if method not in ('solve', 'krylov', 'iter'):
+            raise ValueError('method must be one of "solve", "krylov", ' +
+                             '"iter"')
+
+        if method == 'solve':
+            yield from self._solve_policy(policy, v)
+        elif method == 'krylov':
+            return (yield from self._krylov_policy_eval(policy, v))
+        elif method == 'iter':
+            yield from self._iterative_policy_eval(policy, v)
+
+    def value_iteration(self, mode='sync', v=None, changed_states=None):
+        # 'sync' backs up every state at once from the previous values.
+        # the in-place modes update one state at a time and reuse new
+        # values within the same sweep: 'gauss-seidel' visits states in
+        # index order, 'ordered' visits them outward from the terminal
+        # states and 'prioritized' always backs up the state with the
+        # largest Bellman error. every mode yields the values and the
+        # total absolute change over the last sweep
+
+        # `v` is an optional initial value, e.g. the solution before the
+        # model was edited. if the edits only touched `changed_states`,
+        # 'prioritized' starts from just those states
+        if mode not in ('sync', 'gauss-seidel', 'ordered', 'prioritized'):
+            raise ValueError('mode must be one of "sync", "gauss-seidel", ' +
+                             '"ordered", "prioritized"')
+
+        if v is None:
+            changed_states = None
+        v = self._initial_values(v)
+        if mode == 'sync':
+            yield from self._synchronous_value_iteration(v)
+        elif mode == 'gauss-seidel':
+            yield from self._in_place_value_iteration(
+                v, self.non_terminal_states)
+        elif mode == 'ordered':
+            yield from self._in_place_value_iteration(
+                v, self._terminal_distance_order(), settle=True)
+        elif mode == 'prioritized':
+            yield from self._prioritized_value_iteration(v, changed_states)
+
+    def value_iteration_batch(self, R=None, gammas=None, tol=0, v=None):
+        # value iteration for K variants of this MDP that share P but
+        # have their own rewards `R` (K*`n_states`*`n_actions`) and/or
+        # discount factors `gammas` (K values), all backed up together
+        # in one array operation per sweep. yields the values
+        # (K*`n_states`) and the residual of every member; a member is no
+        # longer backed up once its residual is at most `tol`, and the
+        # generator ends when every member has converged
+        R, gammas, K = self._batch_params(R, gammas)
+        gammas = np.broadcast_to(gammas, K)
+        V = self._initial_batch_values(v, K)
+        epsilon = np.full(K, np.inf)
+        active = np.ones(K, dtype=bool)
+        non_terminal = ~self.terminal_mask
+
+        while active.any():
+            members = np.flatnonzero(active)
+            V_active = V[members]
+            # shared rewards are broadcast rather than copied K times
+            R_active = R if R.ndim == 2 else R[members]
+            Q = (R_active + gammas[members,np.newaxis,np.newaxis] *
+                 self._model.dot_many(V_active.T).transpose(2, 1, 0))
+            new_V = np.where(non_terminal, Q.max(axis=2), V_active)
+            epsilon[members] = np.sum(np.abs(new_V - V_active), axis=1)
+            V[members] = new_V
+            active[members] = epsilon[members] > tol
+            yield V.copy(), epsilon.copy()
+
+    def evaluate_policy_batch(self, policy=None, R=None, gammas=None,
+                              method='iter', tol=0, v=None):
+        # policy evaluation of one policy for K variants of this MDP, as
+        # in `value_iteration_batch`. 'solve' yields the exact values
+        # once, sharing one factorization between all members with the
+        # same discount factor. 'iter' yields synchronous backups of all
+        # members at once until every residual is at most `tol`
+        if policy is None:
+            policy = self.random_policy()
+        self._check_policy_probs(policy)
         if method not in ('solve', 'iter'):
             raise ValueError('method must be one of "solve", "iter"')
 
+        R, gammas, K = self._batch_params(R, gammas)
+        R_pi = np.broadcast_to(np.sum(policy * R, axis=-1), (K, self.n_states))
+        gammas = np.broadcast_to(gammas, K)
+
         if method == 'solve':
-            yield from self._solve_policy(policy)
-        elif method == 'iter':
-            yield from self._iterative_policy_eval(policy)
+            states = self.non_terminal_states
+            V = np.zeros((K, self.n_states), dtype=self.dtype)
+            try:
+                for gamma in np.unique(gammas):
+                    members = np.flatnonzero(gammas == gamma)
+                    Q, T = self._get_factorization(policy, gamma)
+                    y = np.matmul(Q.T, R_pi[members][:,states].T)
+                    V[np.ix_(members, states)] = self._back_substitute(T, y).T
+            except np.linalg.LinAlgError:
+                pass
+            else:
+                yield V, np.zeros(K)
+                return
+
+        P_pi = as_transitions(self._get_P_pi(policy))
+        V = self._initial_batch_values(v, K)
+        epsilon = np.full(K, np.inf)
+        active = np.ones(K, dtype=bool)
+        non_terminal = ~self.terminal_mask
+        while active.any():
+            members = np.flatnonzero(active)
+            V_active = V[members]
+            new_V = np.where(non_terminal, R_pi[members] +
+                             gammas[members,np.newaxis] *
+                             P_pi.dot_many(V_active.T).T, 0)
+            epsilon[members] = np.sum(np.abs(new_V - V_active), axis=1)
+            V[members] = new_V
+            active[members] = epsilon[members] > tol
+            yield V.copy(), epsilon.copy()
+
+    def _batch_params(self, R, gammas):
+        # check the rewards and discount factors of a batch of variants
+        # and work out its size K. members without their own rewards or
+        # discount factor use those of this MDP
+        R = self.R if R is None else np.asarray(R)
+        gammas = self.gamma if gammas is None else np.asarray(gammas, float)
+        if R.shape[-2:] != self.R.shape or R.ndim not in (2, 3):
+            raise ValueError('R must have shape (n_states, n_actions) or ' +
+                             '(K, n_states, n_actions)')
+        if np.ndim(gammas) > 1:
+            raise ValueError('gammas must be a number or a vector')
 
-    def value_iteration(self):
-        v = np.zeros(self.n_states)
+        sizes = set()
+        if R.ndim == 3:
+            sizes.add(R.shape[0])
+        if np.ndim(gammas) == 1:
+            sizes.add(len(gammas))
+        if len(sizes) > 1:
+            raise ValueError('R and gammas must describe the same number ' +
+                             'of variants')
+        return R, gammas, (sizes.pop() if sizes else 1)
+
+    def _initial_batch_values(self, v, K):
+        V = np.zeros((K, self.n_states), dtype=self.dtype)
+        if v is not None:
+            V[:] = v
+            V[:,self.terminal_mask] = 0
+        return V
+
+    def _synchronous_value_iteration(self, v):
+        non_terminal = ~self.terminal_mask
 
         while True:
-            old_v = v
-            for s in range(self.n_states):
-                if self._is_terminal_state(s):
+            # one synchronous backup of every state and action at once;
+            # terminal states keep their value
+            new_v = np.where(non_terminal, self._q_values(v).max(axis=1), v)
+            epsilon = np.sum(np.abs(new_v-v))
+            v = new_v
+            yield v, epsilon
+
+    def _in_place_value_iteration(self, v, order, settle=False):
+        # with `settle`, the first sweep only trusts actions whose
+        # successors have all been backed up already (or are terminal).
+        # visiting states outward from the terminal states, this makes
+        # the first sweep start from the new values of states closer to
+        # a terminal instead of their initial values. it only changes
+        # the starting point, so the fixed point is the same
+        unsettled = (~self.terminal_mask).astype(float) if settle else None
+        while True:
+            epsilon = 0
+            for s in order:
+                q_s = self._state_q_values(s, v)
+                if unsettled is not None:
+                    ready = self._model.dot_row((slice(None),s),
+                                                unsettled) == 0
+                    if ready.any():
+                        q_s = q_s[ready]
+                    unsettled[s] = 0
+                new_value = np.max(q_s)
+                epsilon += abs(new_value - v[s])
+                v[s] = new_value
+            unsettled = None
+            yield v.copy(), epsilon
+
+    def _prioritized_value_iteration(self, v, changed_states=None):
+        # `error` holds the current Bellman error of every state. after
+        # a backup only the predecessors of the updated state can have
+        # a new error, so only those are re-examined. one yield is made
+        # per `n` backups, where `n` is the number of non-terminal
+        # states, so that a yield costs about as much as a sweep. if
+        # `v` is known to be a fixed point apart from `changed_states`,
+        # only those states and their predecessors start with an error,
+        # and after `PRIORITIZED_MAX_FRACTION` of a sweep's backups the
+        # rest is left to synchronous sweeps
+        indptr, predecessors = self._predecessor_index()
+        non_terminal = ~self.terminal_mask
+        if changed_states is None:
+            error = np.where(non_terminal,
+                             np.abs(self._q_values(v).max(axis=1) - v), 0)
+        else:
+            error = np.zeros(self.n_states, dtype=self.dtype)
+            for s in changed_states:
+                seeds = np.append(predecessors[indptr[s]:indptr[s+1]], s)
+                for p in seeds[non_terminal[seeds]]:
+                    error[p] = abs(np.max(self._state_q_values(p, v)) - v[p])
+        queue = [(-error[s], s) for s in np.flatnonzero(error > 0)]
+        heapq.heapify(queue)
+        n = max(self.non_terminal_states.size, 1)
+        budget = (np.inf if changed_states is None else
+                  max(n * PRIORITIZED_MAX_FRACTION, 1))
+
+        while True:
+            epsilon = 0
+            backups = 0
+            while queue and backups < n:
+                if budget <= 0:
+                    yield v.copy(), epsilon
+                    yield from self._synchronous_value_iteration(v)
+                    return
+                priority, s = heapq.heappop(queue)
+                if -priority != error[s]:
+                    # stale entry; the state was re-queued since
                     continue
-                q_s = [self._bellman_optimality_expr(s,a,v)
-                       for a in range(self.n_actions)]
-                v[s] = np.max(q_s)
+                new_value = np.max(self._state_q_values(s, v))
+                epsilon += abs(new_value - v[s])
+                v[s] = new_value
+                error[s] = 0
+                backups += 1
+                budget -= 1
 
-            epsilon = np.sum(np.abs(v-old_v))
-            yield v, epsilon
+                for p in predecessors[indptr[s]:indptr[s+1]]:
+                    if not non_terminal[p]:
+                        continue
+                    e = abs(np.max(self._state_q_values(p, v)) - v[p])
+                    if e != error[p]:
+                        error[p] = e
+                        if e > 0:
+                            heapq.heappush(queue, (-e, p))
+            yield v.copy(), epsilon
+
+    def _initial_values(self, v):
+        # a copy of `v` (zeros if not given), with terminal states at 0
+        if v is None:
+            return np.zeros(self.n_states, dtype=self.dtype)
+        return np.where(self.terminal_mask, 0, v).astype(self.dtype)
+
+    def _state_q_values(self, s, v):
+        return self.R[s] + self.gamma * self._model.dot_row((slice(None),s), v)
+
+    def _predecessor_index(self):
+        # CSR-style index of the states that can move into each state:
+        # the predecessors of `s` are predecessors[indptr[s]:indptr[s+1]]
+        sources, targets = self._model.edges()
+        # successor tables may hold int32 indices, whose product with
+        # `n_states` would overflow on large models
+        keys = np.unique(targets.astype(np.int64) * self.n_states + sources)
+        targets, sources = np.divmod(keys, self.n_states)
+        indptr = np.zeros(self.n_states+1, dtype=int)
+        np.cumsum(np.bincount(targets, minlength=self.n_states),
+                  out=indptr[1:])
+        return indptr, sources
 
-    def policy_iteration(self, policy=None):
-        if policy == None:
+    def _terminal_distance_order(self):
+        # non-terminal states sorted by the number of steps needed to
+        # reach a terminal state; states that cannot reach one go last
+        sources, targets = self._model.edges()
+        distance = np.full(self.n_states, -1)
+        frontier = self.terminal_mask.copy()
+        step = 0
+        while frontier.any():
+            distance[frontier] = step
+            reached = np.zeros(self.n_states, dtype=bool)
+            reached[sources[frontier[targets]]] = True
+            frontier = reached & (distance < 0)
+            step += 1
+        distance[distance < 0] = step
+        states = self.non_terminal_states
+        return states[np.argsort(distance[states], kind='stable')]
+
+    def policy_iteration(self, policy=None, v=None, sweeps=None):
+        # alternates evaluating the policy and making it greedy with
+        # respect to the values, and yields the values, the improved
+        # policy and the total absolute change of the values. without
+        # `sweeps` the policy is evaluated exactly; with `sweeps` it is
+        # modified policy iteration, which only does that many
+        # synchronous backups of the policy from the last values. ends
+        # once the policy is stable and the values no longer change
+
+        # `policy` and `v` are optional starting points, e.g. the
+        # solution from before the model was edited. `policy` is updated
+        # in place
+        if policy is None:
             policy = self.random_policy()
         self._check_policy_probs(policy)
+        if sweeps is not None and sweeps < 1:
+            raise ValueError('sweeps must be at least 1')
 
         P_pi = self._get_P_pi(policy)
         R_pi = self._get_R_pi(policy)
-        v = np.zeros(self.n_states)
+        v = self._initial_values(v)
+        non_terminal = ~self.terminal_mask
 
         while True:
             old_v = v
-            v = self._v_backup_synchronous(v, R_pi, P_pi)
+            if sweeps is None:
+                v = self._policy_values(policy, P_pi, R_pi, v)
+            if v is None:
+                # the policy has no finite values, e.g. it never reaches
+                # a terminal state with gamma=1. back it up once from
+                # the last values instead, which keeps them finite and
+                # lets the improvement steer the policy away from it
+                v = np.where(non_terminal, self._v_backup_synchronous(
+                    old_v, R_pi, P_pi), 0)
+            elif sweeps is not None:
+                for _ in range(sweeps):
+                    v = np.where(non_terminal, self._v_backup_synchronous(
+                        v, R_pi, P_pi), 0)
 
-            for s in range(self.n_states):
-                if self._is_terminal_state(s):
-                    continue
-                q_s = [self._bellman_optimality_expr(s,a,v)
-                       for a in range(self.n_actions)]
-
-                # make the policy choose the best actions with equal
-                # probability
-                maximum = np.max(q_s)
-                best_actions = np.argwhere(q_s == maximum)
-                policy[s].fill(0)
-                np.put(policy[s], best_actions, 1/best_actions.size)
+            # only states where another action is better than what the
+            # policy does are changed, so that ties and rounding cannot
+            # make the policy flip between equally good actions forever
+            q = self._q_values(v)
+            best_q = q.max(axis=1)
+            gain = best_q - np.sum(policy * q, axis=1)
+            improved = np.flatnonzero(non_terminal & (
+                gain > POLICY_IMPROVEMENT_TOLERANCE * (1 + np.abs(best_q))))
+            if improved.size > 0:
+                best = q[improved] == best_q[improved,np.newaxis]
+                policy[improved] = best / best.sum(axis=1, keepdims=True)
+                self._update_policy_rows(P_pi, R_pi, policy, improved)
 
             epsilon = np.sum(np.abs(v-old_v))
             yield v, policy, epsilon
+            if improved.size == 0 and epsilon == 0:
+                return
+
+    def _policy_values(self, policy, P_pi, R_pi, v):
+        # the exact values of `policy`, with the same choice of method as
+        # `evaluate_policy`, or None if I - gamma*P_pi is singular and
+        # they cannot be found. `P_pi` and `R_pi` are those of `policy`
+        method = self._choose_eval_method()
+        if method == 'solve':
+            try:
+                # every iteration of policy iteration has a new policy,
+                # so its factorizations are not kept
+                Q, T = self._get_factorization(policy, self.gamma, P_pi,
+                                               cache=False)
+            except np.linalg.LinAlgError:
+                method = 'krylov'
+            else:
+                states = self.non_terminal_states
+                v = np.zeros(self.n_states, dtype=self.dtype)
+                v[states] = self._back_substitute(
+                    T, np.matmul(Q.T, R_pi[states]))
+                return v
+        # diverging iterates are detected below, not warned about
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            for v, residual in self._krylov_policy_eval(
+                    policy, v, P_pi=P_pi, R_pi=R_pi):
+                pass
+        b_norm = np.linalg.norm(R_pi[self.non_terminal_states]) or 1
+        if not residual <= KRYLOV_TOLERANCE * b_norm:
+            return None
+        return v
 
     def _check_policy_probs(self, policy):
-        for policy_s in policy:
-            if np.sum(policy_s) != 1:
-                raise ValueError('sum of probabilities for each state ' +
-                                 'must be 1')
+        if not np.allclose(np.sum(policy, axis=1), 1, rtol=0,
+                           atol=prob_tolerance(policy.dtype)):
+            raise ValueError('sum of probabilities for each state ' +
+                             'must be 1')
 
     def _is_terminal_state(self, state):
-        # if the state can only transition to itself
-        for P_a in self.P:
-            if P_a[state,state] != 1:
-                return False
-        return True
+        return self.terminal_mask[state]
+
+    def _self_loop_prob(self, a, s):
+        states, probs = self._model.successors(a, s)
+        return np.sum(probs[states == s])
 
     def _get_start_state(self):
-        while True:
-            state = np.random.randint(self.n_states)
-            if not self._is_terminal_state(state):
-                return state
+        if self.non_terminal_states.size == 0:
+            raise ValueError('there are no non-terminal states to start in')
+        return np.random.choice(self.non_terminal_states)
 
     def _get_action(self, state, policy):
         return np.random.choice(np.arange(self.n_actions),
                                 p=policy[state])
 
+    def _draw(self, cum_probs, rng):
+        # one index per row of `cum_probs`, distributed as its increments
+        u = rng.random((cum_probs.shape[0], 1))
+        index = np.sum(cum_probs < u * cum_probs[:,-1:], axis=1)
+        return np.minimum(index, cum_probs.shape[1]-1)
+
     def _get_next_state(self, state, action):
-        return np.random.choice(np.arange(self.n_states),
-                                p=self.P[action,state])
+        states, probs = self._model.successors(action, state)
+        return np.random.choice(states, p=probs)
 
     def _get_R_pi(self, policy):
-        R_pi = np.arange(self.n_states)
-        map_R_pi = lambda s: np.sum(policy[s,a]*self.R[s,a] for a in
-                            np.arange(self.n_actions))
-        return map_R_pi(R_pi)
+        return np.sum(policy * self.R, axis=1)
 
     def _get_P_pi(self, policy):
-        P_pi = np.zeros((self.n_states,self.n_states))
-        actions = np.arange(self.n_actions)
+        # dense models give a `n_states`*`n_states` array, sparse models
+        # a `SparseTransitions` matrix with A*k slots per row
+        return self._model.policy_matrix(policy)
 
-        for s, row in enumerate(P_pi):
-            for s_, val in enumerate(row):
-                P_pi[s,s_] = np.sum(policy[s,a]*self.P[a,s,s_] for a in
-                                    range(self.n_actions))
-
-        return P_pi
+    def _update_policy_rows(self, P_pi, R_pi, policy, states):
+        # after `policy` changed in `states`, bring `P_pi` and `R_pi` up
+        # to date by recomputing only those rows
+        self._model.update_policy_rows(P_pi, policy, states)
+        R_pi[states] = np.sum(policy[states] * self.R[states], axis=1)
 
     def _v_backup_synchronous(self, v, R_pi, P_pi):
-        return R_pi + self.gamma * np.matmul(P_pi, v)
+        return R_pi + self.gamma * as_transitions(P_pi).dot(v)
 
-    def _bellman_optimality_expr(self, s, a, v):
-        return self.R[s,a] + self.gamma * np.sum(self.P[a,s,s_]*v[s_]
-                                                 for s_ in range(self.n_states))
+    def _q_values(self, v):
+        # `n_states`*`n_actions` matrix of R + gamma * P v
+        return self.R + self.gamma * self._model.dot(v).T
 
-    def _solve_policy(self, policy):
-        P_pi = self._get_P_pi(policy)
+    def _chain_values(self, actions, v):
+        # the values of always taking `actions` (one per state), found by
+        # pointer doubling in about log2(`n_states`) array operations
+        # rather than one sweep per step of the longest path. a chain
+        # ends at a terminal state, or at a state whose action may lead
+        # to more than one state, which is valued at `v`. a chain that
+        # never ends (it runs into a cycle) is cut off after that many
+        # steps and valued at `v` where it is cut off, unless nothing is
+        # discounted; then the state keeps its value in `v`
+        states = np.arange(self.n_states)
+        next_states, cum_probs = self._model.cumulative_table()
+        next_states = next_states[actions,states,0]
+        stop = (self.terminal_mask |
+                (cum_probs[actions,states,0] < 1 - self.prob_tolerance))
+        rewards = np.where(stop, 0, self.R[states,actions]).astype(self.dtype)
+        discounts = np.where(stop, 1, self.gamma).astype(self.dtype)
+        next_states = np.where(stop, states, next_states)
+        # after this, every state has taken 2**(bit length) > `n_states`-1
+        # steps, enough to end any chain that ends at all
+        for _ in range(max((self.n_states - 1).bit_length(), 1)):
+            rewards = rewards + discounts * rewards[next_states]
+            discounts = discounts * discounts[next_states]
+            next_states = next_states[next_states]
+        end_values = np.where(self.terminal_mask, 0, v)
+        return np.where(stop[next_states] | (discounts < 1),
+                        rewards + discounts * end_values[next_states],
+                        v).astype(self.dtype)
+
+    def _choose_eval_method(self):
+        n = self.non_terminal_states.size
+        if n <= DIRECT_SOLVE_MAX_STATES:
+            return 'solve'
+        if (n <= DIRECT_SOLVE_DENSE_MAX_STATES and
+                self._model.density() >= DIRECT_SOLVE_MIN_DENSITY):
+            return 'solve'
+        return 'krylov'
+
+    def _solve_policy(self, policy, v=None):
+        # terminal states have value 0, so only the system restricted to
+        # the non-terminal states is solved. its factorization depends
+        # on the policy, gamma and P but not on R, so it is cached and a
+        # re-solve after changing rewards only costs O(n^2)
+        states = self.non_terminal_states
+        try:
+            Q, T = self._get_factorization(policy, self.gamma)
+        except np.linalg.LinAlgError:
+            yield from self._iterative_policy_eval(policy, v)
+            return
+
+        v = np.zeros(self.n_states, dtype=self.dtype)
         R_pi = self._get_R_pi(policy)
-        while True:
-            try:
-                yield np.matmul(np.linalg.inv(np.identity(self.n_states) -
-                                            self.gamma*P_pi),
-                                R_pi), 0
-            except np.linalg.LinAlgError:
-                yield from self._iterative_policy_eval(policy)
+        v[states] = self._back_substitute(T, np.matmul(Q.T, R_pi[states]))
+        yield v, 0
+
+    def _get_factorization(self, policy, gamma, P_pi=None, cache=True):
+        # `P_pi` is that of `policy`, if the caller already has it. a
+        # factorization is only added to the cache with `cache`, but a
+        # cached one is used either way
+        key = self._digest(policy, gamma, self.terminal_mask,
+                           *self._model.arrays())
+        if key in self._factor_cache:
+            return self._factor_cache[key]
+        states = self.non_terminal_states
+        if P_pi is None:
+            P_pi = self._get_P_pi(policy)
+        P_pi = as_transitions(P_pi)
+        A = (np.identity(states.size) -
+             gamma * P_pi.to_dense_block(states))
+        Q, T = np.linalg.qr(A)
+        diagonal = np.abs(np.diagonal(T))
+        if diagonal.size > 0 and np.min(diagonal) <= 1e-12 * np.max(diagonal):
+            raise np.linalg.LinAlgError('singular matrix')
+        if cache:
+            if len(self._factor_cache) >= FACTOR_CACHE_SIZE:
+                del self._factor_cache[next(iter(self._factor_cache))]
+            self._factor_cache[key] = Q, T
+        return Q, T
+
+    def _digest(self, *arrays):
+        h = hashlib.sha1()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            h.update(str((array.dtype, array.shape)).encode())
+            h.update(array.tobytes())
+        return h.hexdigest()
+
+    def _back_substitute(self, T, y):
+        # solve T x = y for upper triangular T. `y` may have a column
+        # per right-hand side
+        x = np.zeros(y.shape)
+        for i in range(y.shape[0]-1, -1, -1):
+            x[i] = (y[i] - np.matmul(T[i,i+1:], x[i+1:])) / T[i,i]
+        return x
+
+    def _krylov_policy_eval(self, policy, v=None, tol=KRYLOV_TOLERANCE,
+                            max_iter=None, P_pi=None, R_pi=None):
+        # BiCGSTAB on (I - gamma*P_pi) v = R_pi restricted to the
+        # non-terminal states, using only products with P_pi
+        if P_pi is None:
+            P_pi = self._get_P_pi(policy)
+        if R_pi is None:
+            R_pi = self._get_R_pi(policy)
+        P_pi = as_transitions(P_pi)
+        non_terminal = ~self.terminal_mask
+        def A(x):
+            return np.where(non_terminal, x - self.gamma * P_pi.dot(x), 0)
+
+        b = np.where(non_terminal, R_pi, 0)
+        b_norm = np.linalg.norm(b) or 1
+        if max_iter is None:
+            max_iter = 10 * self.n_states
+
+        v = self._initial_values(v)
+        r = b - A(v)
+        r_hat = r.copy()
+        rho = alpha = omega = 1
+        p = u = np.zeros(self.n_states)
+        for _ in range(max_iter):
+            residual = np.linalg.norm(r)
+            if residual <= tol * b_norm or not np.isfinite(residual):
+                # a singular system can make the iterates diverge
+                break
+            rho, old_rho = np.dot(r_hat, r), rho
+            if rho == 0:
+                # breakdown; restart from the current iterate
+                r_hat = r.copy()
+                rho, p, u = np.dot(r, r), np.zeros(self.n_states), \
+                            np.zeros(self.n_states)
+                old_rho = alpha = omega = 1
+            p = r + (rho / old_rho) * (alpha / omega) * (p - omega * u)
+            u = A(p)
+            alpha = rho / np.dot(r_hat, u)
+            h = r - alpha * u
+            t = A(h)
+            t_norm = np.dot(t, t)
+            omega = np.dot(t, h) / t_norm if t_norm > 0 else 0
+            v = v + alpha * p + omega * h
+            r = h - omega * t
+            yield v, residual
+        residual = np.linalg.norm(r)
+        yield v, residual
+        return residual <= tol * b_norm
 
-    def _iterative_policy_eval(self, policy):
+    def _iterative_policy_eval(self, policy, v=None):
         P_pi = self._get_P_pi(policy)
         R_pi = self._get_R_pi(policy)
-        v = np.zeros(self.n_states)
+        non_terminal = ~self.terminal_mask
+        v = self._initial_values(v)
 
         while True:
             old_v = v
-            v = self._v_backup_synchronous(v, R_pi, P_pi)
+            v = np.where(non_terminal,
+                         self._v_backup_synchronous(v, R_pi, P_pi), 0)
             epsilon = np.sum(np.abs(v-old_v))
             yield v, epsilon
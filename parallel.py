@@ -0,0 +1,230 @@
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import numpy as np
+from gridworld import GridWorld
+from sweep import attach_arrays, share
+from transitions import (DenseTransitions, DeterministicTransitions,
+                         SparseTransitions)
+
+# synchronous value iteration split over several cores. the states are
+# cut into bands of whole grid rows, and each band is backed up by its
+# own worker. the values live in two shared buffers, one read and one
+# written per sweep, so workers never wait for each other within a
+# sweep. a band's successors lie at most `halo` rows outside of it, so
+# each worker only ever reads its own rows and that many rows of its
+# neighbours: its successor indices are stored relative to that window.
+# each worker returns the residual of its band, and the parent adds
+# them up and tells everyone to start the next sweep
+
+BACKENDS = ('process', 'thread')
+
+def successor_table(model):
+    # (A, S, k) successors of every row and their probabilities, or
+    # None for the probabilities if every row is certain
+    if isinstance(model, DeterministicTransitions):
+        if model.edited_states.size == 0:
+            return model.next_states[..., np.newaxis], None
+        model = model.to_sparse()
+    elif isinstance(model, DenseTransitions):
+        model = SparseTransitions.from_dense(model.P)
+    return model.next_states, model.probs
+
+def halo_rows(next_states, probs, row_width):
+    # how many rows away from its own row a state can move
+    states = np.arange(next_states.shape[-2])[:, np.newaxis]
+    distance = np.abs(next_states - states)
+    if probs is not None:
+        distance = np.where(probs > 0, distance, 0)
+    return -(-int(distance.max(initial=0)) // row_width)
+
+def band_bounds(n_rows, row_width, n_bands):
+    # (lo, hi) state ranges of `n_bands` bands of whole rows
+    rows = np.linspace(0, n_rows, min(n_bands, n_rows) + 1).astype(int)
+    return [(lo * row_width, hi * row_width)
+            for lo, hi in zip(rows[:-1], rows[1:])]
+
+
+class Band(object):
+    # the backups of states `lo`..`hi`, reading only the states
+    # `start`..`stop` around them. `arrays` holds the whole model and
+    # the value buffers, which are not copied
+    def __init__(self, arrays, lo, hi, halo, gamma):
+        n_states = arrays['values'].shape[1]
+        self.lo, self.hi = lo, hi
+        self.start, self.stop = max(lo - halo, 0), min(hi + halo, n_states)
+        self.gamma = gamma
+        self.values = arrays['values']
+        self.next_states = arrays['next_states'][:,lo:hi] - self.start
+        if self.next_states.min(initial=0) < 0 or \
+                self.next_states.max(initial=0) >= self.stop - self.start:
+            raise ValueError('successors outside of the halo')
+        self.probs = (None if arrays['probs'] is None
+                      else arrays['probs'][:,lo:hi])
+        self.R = np.ascontiguousarray(arrays['R'][lo:hi].T)
+        self.terminal = arrays['terminal'][lo:hi]
+
+    def backup(self, src):
+        # back up the band from buffer `src` into the other one, and
+        # return the total absolute change
+        old = self.values[src]
+        successors = old[self.start:self.stop][self.next_states]
+        if self.probs is None:
+            expected = successors[...,0]
+        else:
+            expected = np.sum(self.probs * successors, axis=-1)
+        new = np.max(self.R + self.gamma * expected, axis=0)
+        new[self.terminal] = 0
+        self.values[1-src,self.lo:self.hi] = new
+        return float(np.sum(np.abs(new - old[self.lo:self.hi])))
+
+
+def _band_worker(conn, specs, lo, hi, halo, gamma):
+    # runs in its own process: back up one band whenever the parent
+    # sends the buffer to read from, until it sends None
+    arrays = attach_arrays(specs, writable=True)
+    arrays.setdefault('probs', None)
+    band = Band(arrays, lo, hi, halo, gamma)
+    while True:
+        src = conn.recv()
+        if src is None:
+            break
+        conn.send(band.backup(src))
+    conn.close()
+
+class ShardedValueIteration(object):
+    # `mdp` must number its states row by row, `row_width` states per
+    # row, as `GridWorld` does. it is split into `n_bands` bands, one
+    # per core by default. with the 'thread' backend the bands are
+    # backed up by a thread pool instead of processes, which only pays
+    # off where numpy releases the GIL for most of a backup
+    def __init__(self, mdp, row_width, n_bands=None, backend='process'):
+        if backend not in BACKENDS:
+            raise ValueError('backend must be one of "process", "thread"')
+        if mdp.n_states % row_width != 0:
+            raise ValueError('number of states must be a multiple of ' +
+                             'the row width')
+        self.mdp = mdp
+        self.backend = backend
+        next_states, probs = successor_table(mdp._model)
+        n_rows = mdp.n_states // row_width
+        self.halo = halo_rows(next_states, probs, row_width) * row_width
+        self.bounds = band_bounds(n_rows, row_width,
+                                  n_bands or os.cpu_count() or 1)
+
+        arrays = {
+            'values': np.zeros((2, mdp.n_states), dtype=mdp.dtype),
+            'next_states': next_states,
+            'R': mdp.R,
+            'terminal': mdp.terminal_mask,
+        }
+        if probs is not None:
+            arrays['probs'] = probs
+
+        self.blocks = []
+        self.workers = []
+        if backend == 'thread':
+            arrays.setdefault('probs', None)
+            self.values = arrays['values']
+            self.bands = [Band(arrays, lo, hi, self.halo, mdp.gamma)
+                          for lo, hi in self.bounds]
+            self.pool = ThreadPoolExecutor(len(self.bands))
+            return
+
+        self.blocks, specs = share(arrays)
+        block = self.blocks[list(arrays).index('values')]
+        self.values = np.ndarray(arrays['values'].shape, mdp.dtype,
+                                 buffer=block.buf)
+        try:
+            for lo, hi in self.bounds:
+                conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_band_worker, daemon=True,
+                    args=(child_conn, specs, lo, hi, self.halo, mdp.gamma))
+                process.start()
+                child_conn.close()
+                self.workers.append((process, conn))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join()
+            conn.close()
+        self.workers = []
+        if self.backend == 'thread':
+            self.pool.shutdown()
+        # the buffers cannot be released while arrays still use them
+        self.values = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def sweeps(self, v=None):
+        # like `MDP.value_iteration` in 'sync' mode: yields the values
+        # and the total absolute change of every sweep
+        src = 0
+        self.values[src] = self.mdp._initial_values(v)
+        while True:
+            if self.backend == 'thread':
+                residuals = list(self.pool.map(lambda band: band.backup(src),
+                                               self.bands))
+            else:
+                for _, conn in self.workers:
+                    conn.send(src)
+                residuals = [conn.recv() for _, conn in self.workers]
+            src = 1 - src
+            yield self.values[src].copy(), sum(residuals)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='time sharded value iteration against the ' +
+                    'single-core one on a GridWorld')
+    parser.add_argument('w', type=int)
+    parser.add_argument('h', type=int)
+    parser.add_argument('--bands', type=int, nargs='+',
+                        default=[os.cpu_count() or 1])
+    parser.add_argument('--backend', choices=BACKENDS, default='process')
+    parser.add_argument('--gamma', type=float, default=0.99)
+    parser.add_argument('--dtype', choices=('float64', 'float32'),
+                        default='float64')
+    parser.add_argument('--sweeps', type=int, default=50)
+    return parser.parse_args(argv)
+
+def time_sweeps(iterator, n_sweeps):
+    start = perf_counter()
+    for i, (v, epsilon) in enumerate(iterator, 1):
+        if i >= n_sweeps or epsilon == 0:
+            break
+    return v, i, perf_counter() - start
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    gw = GridWorld(args.w, args.h, [0], gamma=args.gamma, dtype=args.dtype)
+    v, n, single = time_sweeps(gw.mdp.value_iteration(), args.sweeps)
+    print('1 core: {} sweeps, {:.4f}s per sweep'.format(n, single / n))
+    for n_bands in args.bands:
+        with ShardedValueIteration(gw.mdp, gw.w, n_bands,
+                                   args.backend) as sharded:
+            v_sharded, n, elapsed = time_sweeps(sharded.sweeps(),
+                                                args.sweeps)
+        print(('{} bands: {} sweeps, {:.4f}s per sweep, {:.2f}x, max ' +
+               'difference {:.2e}').format(n_bands, n, elapsed / n,
+                                           single / elapsed,
+                                           np.max(np.abs(v - v_sharded))))
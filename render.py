@@ -0,0 +1,147 @@
+from collections import namedtuple
+import numpy as np
+
+# layout and raster rendering of a GridWorld's values, policy and
+# rewards. nothing here depends on tkinter, so the same code is used
+# by the interactive viewer and for headless rendering
+
+# below this many pixels per cell, text is unreadable and cells are
+# drawn into a raster image instead of as separate canvas items
+TEXT_MIN_CELL_PX = 40
+# below this many pixels per cell, there is no room for policy arrows
+# and the policy is shown by colour alone
+GLYPH_MIN_CELL_PX = 5
+MAX_CELL_PX = 100
+MAX_CANVAS_W = 1000
+MAX_CANVAS_H = 800
+
+TERMINAL_COLOUR = (128, 128, 128)
+BACKGROUND_COLOUR = (255, 255, 255)
+GLYPH_COLOUR = (30, 30, 30)
+# one colour per action (left, right, up, down)
+ACTION_COLOURS = np.array([(230, 97, 1), (94, 60, 153),
+                           (253, 184, 99), (178, 171, 210)])
+# colour ramp for values and rewards, from lowest to highest
+RAMP = np.array([(68, 1, 84), (59, 82, 139), (33, 145, 140),
+                 (94, 201, 98), (253, 231, 37)])
+
+# what a solver hands over to a display or writer: copies of the data of
+# one iteration that nothing writes to afterwards. `policy` is a
+# `n_states`*`n_actions` matrix, or None if it is to be derived from the
+# values when it is displayed
+Snapshot = namedtuple('Snapshot', ['iteration', 'values', 'policy',
+                                   'epsilon'])
+
+def frozen(array):
+    array = np.array(array)
+    array.setflags(write=False)
+    return array
+
+class GridLayout(object):
+    # how a `w`*`h` grid is placed on a canvas of at most
+    # `max_w`*`max_h` pixels. cells are square and at most
+    # `MAX_CELL_PX` wide; a cell may be smaller than a pixel, in which
+    # case rendered images are downsampled
+    def __init__(self, w, h, max_w=MAX_CANVAS_W, max_h=MAX_CANVAS_H):
+        self.w, self.h = w, h
+        self.cell_px = min(MAX_CELL_PX, max_w / w, max_h / h)
+        self.canvas_w = max(int(round(self.cell_px * w)), 1)
+        self.canvas_h = max(int(round(self.cell_px * h)), 1)
+        self.show_text = self.cell_px >= TEXT_MIN_CELL_PX
+
+    def coords_generator(self):
+        w_r = self.canvas_w / self.w
+        h_r = self.canvas_h / self.h
+
+        for i in range(self.h):
+            for j in range(self.w):
+                yield w_r, h_r, i, j
+
+    def pixel_cells(self):
+        # for every pixel, the state it shows and its position within
+        # that cell as fractions in [0, 1)
+        rows, fy = self._axis(self.canvas_h, self.h)
+        cols, fx = self._axis(self.canvas_w, self.w)
+        states = rows[:, np.newaxis] * self.w + cols
+        return (states, np.broadcast_to(fy[:, np.newaxis], states.shape),
+                np.broadcast_to(fx, states.shape))
+
+    def _axis(self, n_px, n_cells):
+        position = (np.arange(n_px) + 0.5) * n_cells / n_px
+        cells = np.minimum(position.astype(int), n_cells-1)
+        return cells, position - cells
+
+
+def ramp(x):
+    # map `x` in [0, 1] onto the colour ramp
+    x = np.clip(x, 0, 1) * (len(RAMP)-1)
+    low = np.minimum(x.astype(int), len(RAMP)-2)
+    t = (x - low)[..., np.newaxis]
+    return (1-t) * RAMP[low] + t * RAMP[low+1]
+
+def normalise(x, mask):
+    # scale `x` to [0, 1] using the range of its entries where `mask`
+    if not mask.any():
+        return np.full(x.shape, 0.5)
+    low, high = np.min(x[mask]), np.max(x[mask])
+    if high == low:
+        return np.full(x.shape, 0.5)
+    return (x - low) / (high - low)
+
+def render_values(layout, values, terminal_mask):
+    # `layout.canvas_h`*`layout.canvas_w`*3 image of the values
+    states, _, _ = layout.pixel_cells()
+    image = ramp(normalise(values, ~terminal_mask)[states])
+    image[terminal_mask[states]] = TERMINAL_COLOUR
+    return image.astype(np.uint8)
+
+def render_rewards(layout, rewards, terminal_mask):
+    # each cell is split into four triangles, one per action, pointing
+    # at the side the action moves to
+    states, fy, fx = layout.pixel_cells()
+    dx, dy = fx - 0.5, fy - 0.5
+    actions = np.where(np.abs(dx) >= np.abs(dy),
+                       np.where(dx < 0, 0, 1), np.where(dy < 0, 2, 3))
+    if layout.cell_px < 2:
+        actions = np.zeros(states.shape, dtype=int)
+        rewards = np.mean(rewards, axis=1, keepdims=True)
+
+    mask = np.broadcast_to(~terminal_mask[:, np.newaxis], rewards.shape)
+    image = ramp(normalise(rewards, mask)[states, actions])
+    image[terminal_mask[states]] = TERMINAL_COLOUR
+    return image.astype(np.uint8)
+
+def render_policy(layout, policy, terminal_mask):
+    # with enough room, every most likely action is drawn as a line from
+    # the centre of the cell towards the side it moves to. smaller cells
+    # are coloured by their most likely actions instead
+    states, fy, fx = layout.pixel_cells()
+    best = policy == np.max(policy, axis=1, keepdims=True)
+
+    if layout.cell_px < GLYPH_MIN_CELL_PX:
+        colours = (np.matmul(best, ACTION_COLOURS) /
+                   best.sum(axis=1, keepdims=True))
+        colours[terminal_mask] = TERMINAL_COLOUR
+        return colours[states].astype(np.uint8)
+
+    half_width = max(0.06, 0.5 / layout.cell_px)
+    on_row = np.abs(fy - 0.5) < half_width
+    on_col = np.abs(fx - 0.5) < half_width
+    glyphs = np.array([on_row & (fx >= 0.15) & (fx <= 0.5),
+                       on_row & (fx >= 0.5) & (fx <= 0.85),
+                       on_col & (fy >= 0.15) & (fy <= 0.5),
+                       on_col & (fy >= 0.5) & (fy <= 0.85)])
+    drawn = np.zeros(states.shape, dtype=bool)
+    for a in range(len(glyphs)):
+        drawn |= glyphs[a] & best[states, a]
+
+    image = np.empty(states.shape + (3,), dtype=np.uint8)
+    image[:] = BACKGROUND_COLOUR
+    image[drawn] = GLYPH_COLOUR
+    image[terminal_mask[states]] = TERMINAL_COLOUR
+    return image
+
+def to_ppm(image):
+    # binary PPM encoding of an `h`*`w`*3 uint8 image
+    header = 'P6 {} {} 255\n'.format(image.shape[1], image.shape[0])
+    return header.encode() + np.ascontiguousarray(image).tobytes()
@@ -0,0 +1,179 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from gridworld import GridWorld
+from mdp import MDP
+from transitions import (DenseTransitions, DeterministicTransitions,
+                         SparseTransitions, as_transitions)
+
+# saving and loading of GridWorlds, MDPs and their solutions. everything
+# is stored as a directory with one .npy file per array and a small
+# meta.json, so that large models can be memory-mapped when loaded
+# instead of read into memory. a transition model is stored as the
+# arrays it is constructed from
+
+MODELS = {
+    'dense': DenseTransitions,
+    'sparse': SparseTransitions,
+    'deterministic': DeterministicTransitions,
+}
+
+def save_mdp(mdp, directory, values=None, policy=None):
+    arrays, meta = _model_arrays(mdp.P)
+    arrays['R'] = mdp.R
+    meta['gamma'] = float(mdp.gamma)
+    _save(directory, arrays, values, policy, meta)
+
+def load_mdp(directory, mmap=True):
+    # returns the MDP and its saved values and policy (or None). with
+    # `mmap` the arrays are read-only views of the files
+    meta, arrays = _load(directory, mmap)
+    return (MDP(_model(meta, arrays), arrays['R'], meta['gamma']),
+            arrays.get('values'), arrays.get('policy'))
+
+def save_gridworld(gw, directory):
+    # the last solution of `gw` is saved with it
+    arrays, meta = _model_arrays(gw.P)
+    arrays['R'] = gw.R
+    _save(directory, arrays, gw.last_values, gw.last_policy, dict(meta, **{
+        'w': gw.w,
+        'h': gw.h,
+        'terminal_states': sorted(int(s) for s in gw.terminal_states),
+        'sparse': gw.sparse,
+        'gamma': float(gw.gamma),
+        'dtype': gw.dtype.str,
+        'changed_states': sorted(int(s) for s in gw.changed_states),
+        'last_epsilon': (None if gw.last_epsilon is None
+                         else float(gw.last_epsilon)),
+    }))
+
+def load_gridworld(directory):
+    # a GridWorld is edited in place, so it is read into memory rather
+    # than mapped
+    meta, arrays = _load(directory, mmap=False)
+    gw = GridWorld(meta['w'], meta['h'], meta['terminal_states'],
+                   sparse=meta['sparse'], gamma=meta['gamma'],
+                   dtype=meta['dtype'])
+    gw.P = _model(meta, arrays)
+    gw.R = arrays['R']
+    gw._model = as_transitions(gw.P)
+    gw._build_MDP()
+
+    gw.last_values = arrays.get('values')
+    gw.last_policy = arrays.get('policy')
+    gw.last_epsilon = meta['last_epsilon']
+    gw.changed_states = set(meta['changed_states'])
+    return gw
+
+def _model_arrays(P):
+    # a plain array is saved as it is and loaded back as one
+    model = as_transitions(P)
+    kind = next(kind for kind, cls in MODELS.items()
+                if isinstance(model, cls))
+    arrays = {'model{}'.format(i): array
+              for i, array in enumerate(model.arrays())}
+    return arrays, {'model': kind, 'plain': isinstance(P, np.ndarray),
+                    'model_arrays': len(arrays)}
+
+def _model(meta, arrays):
+    model = [arrays['model{}'.format(i)] for i in range(meta['model_arrays'])]
+    if meta['plain']:
+        return model[0]
+    return MODELS[meta['model']](*model)
+
+def _save(directory, arrays, values, policy, meta):
+    if values is not None:
+        arrays['values'] = values
+    if policy is not None:
+        arrays['policy'] = policy
+    meta['arrays'] = sorted(arrays)
+
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), np.asarray(array))
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+def _load(directory, mmap):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise ValueError('{} is not a saved model'.format(directory))
+    arrays = {name: np.load(os.path.join(directory, name + '.npy'),
+                            mmap_mode='r' if mmap else None)
+              for name in meta['arrays']}
+    return meta, arrays
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'gridworld')
+DEFAULT_CACHE_BYTES = 256 * 2**20
+
+class SolutionCache(object):
+    # optimal values and policies on disk, keyed by `MDP.digest`, so that
+    # any model that was solved before (in this or an earlier session)
+    # is looked up rather than solved again. once the entries take up
+    # more than `max_bytes`, the least recently used ones are removed
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, mdp):
+        # the values and policy of `mdp`, or None if it is not cached
+        path = self._path(mdp.digest())
+        try:
+            values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+            policy = np.load(os.path.join(path, 'policy.npy'), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        # mark the entry as recently used
+        os.utime(path)
+        return values, policy
+
+    def put(self, mdp, values, policy):
+        # entries are written to a temporary directory first, so that
+        # readers never see a partial one
+        path = self._path(mdp.digest())
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            np.save(os.path.join(tmp, 'values.npy'), np.asarray(values))
+            np.save(os.path.join(tmp, 'policy.npy'), np.asarray(policy))
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # already cached
+                shutil.rmtree(tmp)
+                os.utime(path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name),
+                          ignore_errors=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
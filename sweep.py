@@ -0,0 +1,201 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from time import perf_counter
+import numpy as np
+from gridworld import GridWorld
+from mdp import MDP
+
+# solves many variants of a GridWorld across a process pool. variants
+# that share dimensions and terminal states share one transition table,
+# which the parent builds once and places in shared memory; workers map
+# it without copying and only build the rewards of their own job.
+# results are streamed back in the order jobs finish
+
+# keys of a job, and the values used when a job does not set them
+JOB_DEFAULTS = {
+    'w': 4,
+    'h': 4,
+    'terminal_states': [0],
+    'gamma': 1,
+    'step_reward': -1,
+    'method': 'vi',
+    'tol': 1e-6,
+    'max_iter': 10000,
+}
+SWEEP_METHODS = ('vi', 'pi')
+
+def expand_jobs(config):
+    # `config` is either a list of jobs or a dict whose list-valued
+    # entries are swept over (every combination becomes a job).
+    # `terminal_states` is a list of states, so it is swept over if it
+    # is a list of lists. every job is checked here, so that a bad one
+    # is refused before anything is solved
+    if isinstance(config, list):
+        for job in config:
+            check_keys(job)
+        jobs = [dict(JOB_DEFAULTS, **job) for job in config]
+    else:
+        jobs = sweep_jobs(config)
+    for job in jobs:
+        if job['method'] not in SWEEP_METHODS:
+            raise ValueError('method must be one of "vi", "pi"')
+    return jobs
+
+def check_keys(settings):
+    for key in settings:
+        if key not in JOB_DEFAULTS:
+            raise ValueError('unknown job setting: {}'.format(key))
+
+def sweep_jobs(config):
+    check_keys(config)
+    swept = {}
+    for key, value in config.items():
+        if key == 'terminal_states':
+            is_sweep = len(value) > 0 and isinstance(value[0], list)
+        else:
+            is_sweep = isinstance(value, list)
+        swept[key] = value if is_sweep else [value]
+
+    keys = list(swept)
+    return [dict(JOB_DEFAULTS, **dict(zip(keys, values)))
+            for values in itertools.product(*(swept[k] for k in keys))]
+
+def structure_key(job):
+    return (job['w'], job['h'], tuple(sorted(job['terminal_states'])))
+
+
+class SharedModel(object):
+    # the transition model of one GridWorld structure, in shared memory.
+    # `spec` is the picklable description workers attach with: the
+    # model class and the arrays it is constructed from
+    def __init__(self, gw):
+        model = gw.mdp.P
+        self.blocks, arrays = share(dict(enumerate(model.arrays())))
+        self.spec = {'model': type(model), 'arrays': arrays}
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+# shared memory blocks attached by this worker process, by block name
+_attached = {}
+
+def share(arrays):
+    # copy a dict of arrays into new shared memory blocks. returns the
+    # blocks, which the caller owns and has to unlink, and a picklable
+    # description of every array by name
+    blocks = []
+    specs = {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def attach_arrays(specs, writable=False):
+    # the arrays described by `specs` (as returned by `share`), backed
+    # by the shared memory blocks themselves
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        if block_name not in _attached:
+            _attached[block_name] = _open_block(block_name)
+        arrays[name] = np.ndarray(shape, dtype,
+                                  buffer=_attached[block_name].buf)
+        arrays[name].setflags(write=writable)
+    return arrays
+
+def attach(spec):
+    arrays = attach_arrays(spec['arrays'])
+    return spec['model'](*(arrays[i] for i in range(len(arrays))))
+
+def _open_block(name):
+    # blocks are owned (and unlinked) by the parent. pool workers share
+    # the parent's resource tracker, so on pythons without `track` the
+    # repeated registration is harmless
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def solve_job(index, job, spec):
+    start = perf_counter()
+    P = attach(spec)
+    R = np.full((P.n_states, P.n_actions), float(job['step_reward']))
+    R[job['terminal_states']] = 0
+    mdp = MDP(P, R, job['gamma'])
+    setup_time = perf_counter() - start
+
+    v, _, stats = mdp.solve(job['method'], tol=job['tol'],
+                            max_iter=job['max_iter'], trace_memory=False)
+
+    return {
+        'index': index,
+        'job': job,
+        'iterations': stats.iterations,
+        'residual': stats.residuals[-1],
+        'converged': stats.converged,
+        'value_min': float(np.min(v)),
+        'value_mean': float(np.mean(v)),
+        'setup_time': setup_time,
+        'wall_time': perf_counter() - start,
+        'pid': os.getpid(),
+    }
+
+def run_sweep(jobs, workers=None):
+    # yield the result of every job as soon as it finishes
+    models = {}
+    try:
+        for job in jobs:
+            key = structure_key(job)
+            if key not in models:
+                gw = GridWorld(job['w'], job['h'], job['terminal_states'])
+                models[key] = SharedModel(gw)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(solve_job, i, job,
+                                   models[structure_key(job)].spec)
+                       for i, job in enumerate(jobs)]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        for model in models.values():
+            model.close()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='solve many GridWorld variants across a process pool')
+    parser.add_argument('config', help='JSON file with a list of jobs or ' +
+                        'a dict of settings to sweep over ("-" for stdin)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', help='write results as JSON lines here')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.config == '-':
+        config = json.load(sys.stdin)
+    else:
+        with open(args.config) as f:
+            config = json.load(f)
+    jobs = expand_jobs(config)
+
+    out = open(args.out, 'w') if args.out else sys.stdout
+    start = perf_counter()
+    try:
+        for result in run_sweep(jobs, args.workers):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print('{} jobs in {:.2f}s'.format(len(jobs), perf_counter() - start),
+          file=sys.stderr)
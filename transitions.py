@@ -0,0 +1,511 @@
+import numpy as np
+
+# transition models share one small interface so that `MDP` and
+# `GridWorld` never need to know how probabilities are stored. all
+# classes may hold a single matrix (shape S x S, e.g. a policy-induced
+# P_pi) or one matrix per action (shape A x S x S)
+
+class DenseTransitions(object):
+    def __init__(self, P):
+        self.P = P
+        self.n_states = P.shape[-1]
+        if self.P.ndim == 3:
+            self.n_actions = P.shape[0]
+
+    @property
+    def shape(self):
+        return self.P.shape
+
+    @property
+    def nbytes(self):
+        return self.P.nbytes
+
+    def dot(self, v):
+        # expected value of `v` after one transition, for every row
+        return np.matmul(self.P, v)
+
+    def dot_many(self, V):
+        # `dot` for every column of the `n_states`*K matrix `V`
+        return np.matmul(self.P, V)
+
+    def row(self, *index):
+        return self.P[index]
+
+    def dot_row(self, index, v):
+        return np.matmul(self.P[index], v)
+
+    def successors(self, *index):
+        row = self.P[index]
+        states = np.flatnonzero(row)
+        return states, row[states]
+
+    def set_successors(self, index, states, probs):
+        self.P[index].fill(0)
+        self.P[index + (states,)] = probs
+
+    def set_row(self, index, row):
+        self.P[index] = row
+
+    def row_sums(self):
+        return self.P.sum(axis=-1)
+
+    def policy_matrix(self, policy):
+        # P_pi[s,s_] = sum_a policy[s,a] * P[a,s,s_]
+        return np.einsum('sa,ast->st', policy, self.P)
+
+    def update_policy_rows(self, P_pi, policy, states):
+        # recompute only the rows of `P_pi` for `states`, in place
+        P_pi[states] = np.einsum('sa,ast->st', policy[states],
+                                 self.P[:,states])
+
+    def diagonal(self):
+        # probability of each state transitioning to itself
+        return np.diagonal(self.P, axis1=-2, axis2=-1)
+
+    def edges(self):
+        # (source, target) pairs of every possible transition
+        _, sources, targets = np.nonzero(self.P)
+        return sources, targets
+
+    def density(self):
+        # fraction of nonzero entries per row
+        return np.count_nonzero(self.P) / self.P.size
+
+    def arrays(self):
+        return (self.P,)
+
+    def to_dense_block(self, states):
+        # the square submatrix of rows and columns `states`
+        return self.P[np.ix_(states, states)]
+
+    def cumulative_table(self):
+        return SparseTransitions.from_dense(self.P).cumulative_table()
+
+    def to_dense(self):
+        return self.P
+
+
+class SparseTransitions(object):
+    # padded next-state/probability table: row `s` (of action `a`, if
+    # there is an action axis) moves to `next_states[a,s,i]` with
+    # probability `probs[a,s,i]`, for each of the `k` slots. unused
+    # slots point back at `s` with probability 0, so gathers through
+    # them are always in range and contribute nothing
+    def __init__(self, next_states, probs):
+        if next_states.shape != probs.shape or next_states.ndim not in (2, 3):
+            raise ValueError('next_states and probs must have the same ' +
+                             'shape (S, k) or (A, S, k)')
+        self.next_states = next_states
+        self.probs = probs
+        self.n_states = next_states.shape[-2]
+        self.k = next_states.shape[-1]
+        if next_states.ndim == 3:
+            self.n_actions = next_states.shape[0]
+
+    @classmethod
+    def deterministic(cls, next_states):
+        # `next_states` has shape (S,) or (A, S): one certain successor
+        # per row
+        next_states = next_states[..., np.newaxis]
+        return cls(next_states, np.ones(next_states.shape))
+
+    @classmethod
+    def from_dense(cls, P):
+        P = np.asarray(P)
+        k = max(int(np.max(np.count_nonzero(P, axis=-1))), 1)
+        # stable sort on "is zero" moves the nonzero columns of every
+        # row to the front while keeping them in index order
+        order = np.argsort(P == 0, axis=-1, kind='stable')[..., :k]
+        probs = np.take_along_axis(P, order, axis=-1)
+        own = np.arange(P.shape[-2])[:, np.newaxis]
+        next_states = np.where(probs != 0, order, own)
+        return cls(next_states, probs)
+
+    @property
+    def shape(self):
+        return self.next_states.shape[:-1] + (self.n_states,)
+
+    @property
+    def nbytes(self):
+        return self.next_states.nbytes + self.probs.nbytes
+
+    def dot(self, v):
+        return np.sum(self.probs * v[self.next_states], axis=-1)
+
+    def dot_many(self, V):
+        return np.sum(self.probs[...,np.newaxis] * V[self.next_states],
+                      axis=-2)
+
+    def row(self, *index):
+        row = np.zeros(self.n_states)
+        np.add.at(row, self.next_states[index], self.probs[index])
+        return row
+
+    def dot_row(self, index, v):
+        return np.sum(self.probs[index] * v[self.next_states[index]],
+                      axis=-1)
+
+    def successors(self, *index):
+        probs = self.probs[index]
+        keep = probs != 0
+        return self.next_states[index][keep], probs[keep]
+
+    def set_successors(self, index, states, probs):
+        states = np.asarray(states)
+        if states.size > self.k:
+            self._widen(states.size)
+        s = index[-1]
+        self.next_states[index].fill(s)
+        self.probs[index].fill(0)
+        self.next_states[index][:states.size] = states
+        self.probs[index][:states.size] = probs
+
+    def set_row(self, index, row):
+        states = np.flatnonzero(row)
+        self.set_successors(index, states, row[states])
+
+    def row_sums(self):
+        return self.probs.sum(axis=-1)
+
+    def policy_matrix(self, policy):
+        # every (action, slot) pair of state `s` becomes one slot of row
+        # `s` in P_pi, weighted by the probability of the action. the
+        # successor indices do not depend on the policy, so they are
+        # shared by every P_pi built from this table
+        next_states = self.next_states.transpose(1, 0, 2)
+        next_states = next_states.reshape(self.n_states, -1)
+        return SparseTransitions(next_states,
+                                 self._policy_probs(policy, slice(None)))
+
+    def update_policy_rows(self, P_pi, policy, states):
+        P_pi.probs[states] = self._policy_probs(policy, states)
+
+    def diagonal(self):
+        own = np.arange(self.n_states)[:, np.newaxis]
+        return np.sum(self.probs * (self.next_states == own), axis=-1)
+
+    def edges(self):
+        keep = self.probs > 0
+        sources = np.broadcast_to(np.arange(self.n_states)[:, np.newaxis],
+                                  self.next_states.shape)
+        return sources[keep], self.next_states[keep]
+
+    def density(self):
+        return min(self.k / self.n_states, 1)
+
+    def arrays(self):
+        return self.next_states, self.probs
+
+    def to_dense_block(self, states):
+        # the square submatrix of rows and columns `states`, without
+        # materialising the full matrix
+        position = np.full(self.n_states, -1)
+        position[states] = np.arange(len(states))
+        columns = position[self.next_states[states]]
+        rows = np.broadcast_to(np.arange(len(states))[:, np.newaxis],
+                               columns.shape)
+        keep = columns >= 0
+        block = np.zeros((len(states), len(states)))
+        np.add.at(block, (rows[keep], columns[keep]),
+                  self.probs[states][keep])
+        return block
+
+    def cumulative_table(self):
+        # successor indices together with the running sum of their
+        # probabilities along each row, for inverse transform sampling
+        return self.next_states, np.cumsum(self.probs, axis=-1)
+
+    def to_dense(self):
+        P = np.zeros(self.shape)
+        rows = np.indices(self.next_states.shape)[:-1]
+        np.add.at(P, tuple(rows) + (self.next_states,), self.probs)
+        return P
+
+    def _policy_probs(self, policy, states):
+        probs = (self.probs[:,states].transpose(1, 0, 2) *
+                 policy[states][:,:,np.newaxis])
+        return probs.reshape(probs.shape[0], -1)
+
+    def _widen(self, k):
+        # grow every row to `k` slots, padding with self loops
+        pad = k - self.k
+        own = np.arange(self.n_states)[:, np.newaxis]
+        own = np.broadcast_to(own, self.next_states.shape[:-1] + (pad,))
+        self.next_states = np.concatenate((self.next_states, own), axis=-1)
+        self.probs = np.concatenate(
+            (self.probs, np.zeros(own.shape, dtype=self.probs.dtype)),
+            axis=-1)
+        self.k = k
+
+
+class DeterministicTransitions(object):
+    # successor table for models where (almost) every row moves to one
+    # state with certainty: row `s` (of action `a`) moves to
+    # `next_states[a,s]`. there are no probabilities, so a backup is a
+    # single gather. the few states given a row that is not certain
+    # (`edited_states`, in increasing order) are kept in a padded
+    # table like `SparseTransitions`, with one row per edited state and
+    # unused slots pointing back at the state itself. once every row of
+    # an edited state is certain again, it moves back into the table
+    # `dtype` is that of the probabilities of edited states
+    def __init__(self, next_states, edited_states=None,
+                 edited_next_states=None, edited_probs=None,
+                 dtype=np.float64):
+        if next_states.ndim not in (1, 2):
+            raise ValueError('next_states must have shape (S,) or (A, S)')
+        self.next_states = next_states
+        self.n_states = next_states.shape[-1]
+        if next_states.ndim == 2:
+            self.n_actions = next_states.shape[0]
+        if edited_states is None:
+            edited_states = np.zeros(0, dtype=next_states.dtype)
+            edited_next_states = np.zeros(next_states.shape[:-1] + (0, 1),
+                                          dtype=next_states.dtype)
+            edited_probs = np.zeros(edited_next_states.shape, dtype=dtype)
+        self.dtype = edited_probs.dtype
+        self.edited_states = edited_states
+        self.edited_next_states = edited_next_states
+        self.edited_probs = edited_probs
+
+    @classmethod
+    def detect(cls, P, tol=0):
+        # a `DeterministicTransitions` with the same rows as the model
+        # `P`, or None if some row of `P` does not move to one state with
+        # a probability of at least 1 - `tol`. the rows of `P` must be
+        # valid distributions
+        P = as_transitions(P)
+        if isinstance(P, DeterministicTransitions):
+            return P
+        if isinstance(P, DenseTransitions):
+            probs, next_states = P.P, None
+        else:
+            probs, next_states = P.probs, P.next_states
+        if not np.all(np.max(probs, axis=-1) >= 1 - tol):
+            return None
+        slots = np.argmax(probs, axis=-1)
+        if next_states is not None:
+            slots = np.take_along_axis(next_states, slots[...,np.newaxis],
+                                       axis=-1)[...,0]
+        return cls(slots.astype(index_dtype(P.n_states)), dtype=probs.dtype)
+
+    @property
+    def shape(self):
+        return self.next_states.shape + (self.n_states,)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays())
+
+    @property
+    def k(self):
+        return self.edited_next_states.shape[-1]
+
+    def dot(self, v):
+        result = v[self.next_states]
+        if self.edited_states.size > 0:
+            result[...,self.edited_states] = np.sum(
+                self.edited_probs * v[self.edited_next_states], axis=-1)
+        return result
+
+    def dot_many(self, V):
+        result = V[self.next_states]
+        if self.edited_states.size > 0:
+            result[...,self.edited_states,:] = np.sum(
+                self.edited_probs[...,np.newaxis] *
+                V[self.edited_next_states], axis=-2)
+        return result
+
+    def row(self, *index):
+        row = np.zeros(self.n_states)
+        states, probs = self.successors(*index)
+        np.add.at(row, states, probs)
+        return row
+
+    def dot_row(self, index, v):
+        i = self._edited_index(index[-1])
+        if i is None:
+            return v[self.next_states[index]]
+        index = index[:-1] + (i,)
+        return np.sum(self.edited_probs[index] *
+                      v[self.edited_next_states[index]], axis=-1)
+
+    def successors(self, *index):
+        i = self._edited_index(index[-1])
+        if i is None:
+            return np.array([self.next_states[index]]), np.ones(1)
+        index = index[:-1] + (i,)
+        probs = self.edited_probs[index]
+        keep = probs != 0
+        return self.edited_next_states[index][keep], probs[keep]
+
+    def set_successors(self, index, states, probs):
+        states = np.asarray(states)
+        probs = np.asarray(probs, dtype=float)
+        s = index[-1]
+        i = self._edited_index(s)
+        if i is None:
+            if states.size == 1 and probs[0] == 1:
+                self.next_states[index] = states[0]
+                return
+            i = self._add_edited_state(s)
+        if states.size > self.k:
+            self._widen(states.size)
+
+        index = index[:-1] + (i,)
+        self.edited_next_states[index] = s
+        self.edited_probs[index] = 0
+        self.edited_next_states[index][:states.size] = states
+        self.edited_probs[index][:states.size] = probs
+        self._restore_if_certain(s)
+
+    def set_row(self, index, row):
+        states = np.flatnonzero(row)
+        self.set_successors(index, states, row[states])
+
+    def row_sums(self):
+        sums = np.ones(self.next_states.shape, dtype=self.dtype)
+        sums[...,self.edited_states] = self.edited_probs.sum(axis=-1)
+        return sums
+
+    def policy_matrix(self, policy):
+        # without edited states, row `s` of P_pi moves to the successor
+        # of each action with the probability of that action
+        if self.edited_states.size > 0:
+            return self.to_sparse().policy_matrix(policy)
+        return SparseTransitions(self.next_states.T.copy(), np.array(policy))
+
+    def update_policy_rows(self, P_pi, policy, states):
+        if self.edited_states.size > 0:
+            P_pi.probs[states] = self._policy_probs(policy, states)
+        else:
+            P_pi.probs[states] = policy[states]
+
+    def diagonal(self):
+        own = np.arange(self.n_states)
+        diagonal = (self.next_states == own).astype(self.dtype)
+        diagonal[...,self.edited_states] = np.sum(
+            self.edited_probs *
+            (self.edited_next_states ==
+             self.edited_states[:,np.newaxis]), axis=-1)
+        return diagonal
+
+    def edges(self):
+        certain = np.ones(self.n_states, dtype=bool)
+        certain[self.edited_states] = False
+        sources = np.broadcast_to(np.arange(self.n_states),
+                                  self.next_states.shape)
+        keep = np.broadcast_to(certain, self.next_states.shape)
+
+        edited_keep = self.edited_probs > 0
+        edited_sources = np.broadcast_to(
+            self.edited_states[:,np.newaxis], self.edited_probs.shape)
+        return (np.concatenate((sources[keep], edited_sources[edited_keep])),
+                np.concatenate((self.next_states[keep],
+                                self.edited_next_states[edited_keep])))
+
+    def density(self):
+        return min(self.k / self.n_states, 1)
+
+    def arrays(self):
+        return (self.next_states, self.edited_states,
+                self.edited_next_states, self.edited_probs)
+
+    def to_dense_block(self, states):
+        return self.to_sparse().to_dense_block(states)
+
+    def cumulative_table(self):
+        if self.edited_states.size > 0:
+            return self.to_sparse().cumulative_table()
+        return (self.next_states[...,np.newaxis],
+                np.ones(self.next_states.shape + (1,), dtype=self.dtype))
+
+    def to_sparse(self):
+        # the same model as a `SparseTransitions`, `k` slots wide
+        next_states = np.repeat(self.next_states[...,np.newaxis], self.k,
+                                axis=-1)
+        own = np.arange(self.n_states)[:, np.newaxis]
+        next_states[...,1:] = own
+        probs = np.zeros(next_states.shape, dtype=self.dtype)
+        probs[...,0] = 1
+        next_states[...,self.edited_states,:] = self.edited_next_states
+        probs[...,self.edited_states,:] = self.edited_probs
+        return SparseTransitions(next_states, probs)
+
+    def to_dense(self):
+        return self.to_sparse().to_dense()
+
+    def _policy_probs(self, policy, states):
+        # rows `states` of the probabilities of the P_pi built from
+        # `to_sparse()`, without building the whole table: a row that is
+        # not edited only has the action probabilities in the first slot
+        # of every action
+        if isinstance(states, slice):
+            states = np.arange(self.n_states)[states]
+        states = np.asarray(states)
+        n_edited = self.edited_states.size
+        i = np.searchsorted(self.edited_states, states)
+        edited = i < n_edited
+        edited[edited] = self.edited_states[i[edited]] == states[edited]
+        probs = np.zeros((states.size, self.next_states.shape[0], self.k),
+                         dtype=self.dtype)
+        probs[...,0] = 1
+        probs[edited] = self.edited_probs[:,i[edited]].transpose(1, 0, 2)
+        probs = probs * policy[states][:,:,np.newaxis]
+        return probs.reshape(states.size, -1)
+
+    def _edited_index(self, s):
+        # position of `s` among the edited states, or None
+        i = np.searchsorted(self.edited_states, s)
+        if i < self.edited_states.size and self.edited_states[i] == s:
+            return i
+        return None
+
+    def _add_edited_state(self, s):
+        # move the rows of `s` out of the table into the edited rows
+        i = np.searchsorted(self.edited_states, s)
+        next_states = np.full(self.next_states.shape[:-1] + (self.k,), s,
+                              dtype=self.next_states.dtype)
+        next_states[...,0] = self.next_states[...,s]
+        probs = np.zeros(next_states.shape, dtype=self.dtype)
+        probs[...,0] = 1
+        self.edited_states = np.insert(self.edited_states, i, s)
+        self.edited_next_states = np.insert(self.edited_next_states, i,
+                                            next_states, axis=-2)
+        self.edited_probs = np.insert(self.edited_probs, i, probs, axis=-2)
+        return i
+
+    def _restore_if_certain(self, s):
+        i = self._edited_index(s)
+        probs = self.edited_probs[...,i,:]
+        certain = probs == 1
+        if not np.all(np.any(certain, axis=-1)):
+            return
+        slots = np.argmax(certain, axis=-1)[...,np.newaxis]
+        self.next_states[...,s] = np.take_along_axis(
+            self.edited_next_states[...,i,:], slots, axis=-1)[...,0]
+        self.edited_states = np.delete(self.edited_states, i)
+        self.edited_next_states = np.delete(self.edited_next_states, i,
+                                            axis=-2)
+        self.edited_probs = np.delete(self.edited_probs, i, axis=-2)
+
+    def _widen(self, k):
+        pad = k - self.k
+        own = np.broadcast_to(self.edited_states[:, np.newaxis],
+                              self.edited_next_states.shape[:-1] + (pad,))
+        self.edited_next_states = np.concatenate(
+            (self.edited_next_states, own), axis=-1)
+        self.edited_probs = np.concatenate(
+            (self.edited_probs, np.zeros(own.shape, dtype=self.dtype)),
+            axis=-1)
+
+
+def index_dtype(n_states):
+    # the smallest integer type commonly used for indexing that can hold
+    # every state number
+    return np.int32 if n_states <= np.iinfo(np.int32).max else np.int64
+
+def as_transitions(P):
+    if isinstance(P, (DenseTransitions, SparseTransitions,
+                      DeterministicTransitions)):
+        return P
+    return DenseTransitions(np.asarray(P))
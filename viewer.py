@@ -1,24 +1,52 @@
-from time import sleep
-from threading import Thread
+from threading import Event, Lock, Thread
+from time import perf_counter
 import tkinter as tk
 import numpy as np
+from render import (GridLayout, Snapshot, frozen, render_policy,
+                    render_rewards, render_values, to_ppm)
 
 class GridWorldViewer(object):
+    # the solver runs at full speed in a worker thread and publishes a
+    # snapshot after every iteration into a single latest-value slot.
+    # the Tk side looks at the slot every `frame_delay` ms and displays
+    # the newest snapshot at most once per `delay` seconds, so `delay`
+    # only paces the display and never holds back the solver
+
+    # when cells are large enough to read text (see `GridLayout`), the
+    # canvas items of every cell are created once and kept. each frame
+    # only reconfigures the items of cells whose data changed since
+    # they were last drawn, and nothing is done at all unless new data
+    # or a view switch arrived. smaller cells are rendered into a single
+    # image scaled to the window instead
+
+    # the `GridWorld.solve` method run by the viewer
+    method = None
+
     def __init__(self, gw):
         self.gw = gw
         self.running = True
-        self.mainloop_done = False
 
         self.delay = 0.5
-        self.pause = False
+        self.frame_delay = 20
+        self.unpaused = Event()
+        self.unpaused.set()
         self.view = 'values'
         self.cur_values = None
         self.cur_policy = None
-        self.cur_rewards = None
-
-        self.canvas_w = self.gw.w * 100
-        self.canvas_h = self.gw.h * 100
-        self.cv = tk.Canvas(width=self.canvas_w, height=self.canvas_h)
+        self.cur_rewards = frozen(self.gw.R)
+
+        # the newest snapshot published by the solver thread
+        self.latest = None
+        self.latest_lock = Lock()
+        self.shown = None
+        self.last_shown_at = 0
+
+        self.layout = GridLayout(self.gw.w, self.gw.h)
+        self.canvas_w = self.layout.canvas_w
+        self.canvas_h = self.layout.canvas_h
+        self.window_size = (self.canvas_w, self.canvas_h)
+        self.cv = tk.Canvas(width=self.canvas_w, height=self.canvas_h,
+                            highlightthickness=0)
         self.cv.master.bind('v', lambda event: setattr(self, 'view', 'values'))
         self.cv.master.bind('p', lambda event: setattr(self, 'view', 'policy'))
         self.cv.master.bind('r', lambda event: setattr(self, 'view', 'rewards'))
@@ -26,14 +54,19 @@ class GridWorldViewer(object):
         self.cv.master.bind('[', self.slower)
         self.cv.master.bind('-', self.toggle_pause)
         self.cv.master.bind('q', self.quit)
-        self.cv.pack()
+        # closing the window has to stop the solver thread like 'q' does
+        self.cv.master.protocol('WM_DELETE_WINDOW', lambda: self.quit(None))
+        self.cv.bind('<Configure>', self.resize)
+        self.cv.pack(fill='both', expand=True)
+        self.build_layout()
 
-        self.thread = Thread(target=self.collect_data)
+        self.thread = Thread(target=self.collect_data, daemon=True)
 
     def run(self):
         try:
             self.thread.start()
             self.mainloop()
+            self.cv.mainloop()
         except KeyboardInterrupt:
             self.quit(None)
 
@@ -51,215 +84,222 @@ class GridWorldViewer(object):
 
     def quit(self, event):
         self.running = False
+        self.unpaused.set()
         self.thread.join()
         self.cv.quit()
         self.cv.master.destroy()
 
+    def resize(self, event):
+        # fit the grid into the new window size, switching between text
+        # and raster rendering if the cells became large or small enough
+        if (event.width, event.height) == self.window_size:
+            return
+        self.window_size = (event.width, event.height)
+        self.layout = GridLayout(self.gw.w, self.gw.h,
+                                 event.width, event.height)
+        self.canvas_w = self.layout.canvas_w
+        self.canvas_h = self.layout.canvas_h
+        self.build_layout()
+
     def toggle_pause(self, event):
-        self.pause = not self.pause
+        # pausing stops the solver as well as the display
+        if self.unpaused.is_set():
+            self.unpaused.clear()
+        else:
+            self.unpaused.set()
 
     def collect_data(self):
-        # this will be run in the background
-        while self.running:
-            if self.pause:
-                # prevents the program from slowing down
-                sleep(self.delay)
-                continue
-            self.cur_values = self.get_values()
-            self.cur_policy = self.get_policy()
-            self.cur_rewards = self.get_rewards()
-            sleep(self.delay)
+        # this will be run in the background, until the solver converges
+        # or the viewer is closed
+        self.gw.solve(self.method, callback=self.observe, trace_memory=False)
+
+    def observe(self, iteration, values, policy, epsilon):
+        # called by the solver after every iteration. returning True
+        # stops it
+        self.publish(Snapshot(iteration, frozen(values),
+                              None if policy is None else frozen(policy),
+                              epsilon))
+        self.unpaused.wait()
+        return not self.running
+
+    def publish(self, snapshot):
+        with self.latest_lock:
+            self.latest = snapshot
+
+    def take_snapshot(self):
+        with self.latest_lock:
+            return self.latest
 
     def mainloop(self):
         if self.running:
-            self.cv.delete('all')
-            if self.view == 'values':
-                self.update_values_view(self.cur_values)
-            elif self.view == 'policy':
-                self.update_policy_view(self.cur_policy)
-            elif self.view == 'rewards':
-                self.update_rewards_view(self.cur_rewards)
-            self.cv.update()
-        self.cv.master.after(1, self.mainloop)
-
-    def get_values(self):
-        pass
-
-    def get_policy(self):
-        pass
-
-    def get_rewards(self):
-        pass
+            if self.view != self.drawn_view:
+                self.switch_view(self.view)
+
+            snapshot = self.take_snapshot()
+            if (snapshot is not self.shown and self.unpaused.is_set() and
+                    perf_counter() - self.last_shown_at >= self.delay):
+                self.shown = snapshot
+                self.last_shown_at = perf_counter()
+                self.cur_values = snapshot.values
+                self.cur_policy = snapshot.policy
+
+            if self.view == 'policy' and self.cur_policy is None and \
+                    self.cur_values is not None:
+                self.cur_policy = self.policy_from_values(self.cur_values)
+
+            version = (self.drawn_view, id(self.shown))
+            if version != self.drawn_version:
+                self.drawn_version = version
+                if not self.layout.show_text:
+                    self.update_raster_view()
+                elif self.view == 'values':
+                    self.update_values_view(self.cur_values)
+                elif self.view == 'policy':
+                    self.update_policy_view(self.cur_policy)
+                elif self.view == 'rewards':
+                    self.update_rewards_view(self.cur_rewards)
+        self.cv.master.after(self.frame_delay, self.mainloop)
+
+    def policy_from_values(self, values):
+        return self.gw.mdp.greedy_policy(values)
 
     def coords_generator(self):
-        w_r = self.canvas_w / self.gw.w
-        h_r = self.canvas_h / self.gw.h
+        return self.layout.coords_generator()
+
+    def build_layout(self):
+        # create the items of every cell, tagged with the view they
+        # belong to. the last data drawn into them is kept so that later
+        # frames can tell which cells changed
+        self.cv.delete('all')
+        self.drawn_view = None
+        self.drawn_version = -1
+        if not self.layout.show_text:
+            self.image_item = self.cv.create_image(0, 0, anchor='nw')
+            self.photo = None
+            return
 
-        for i in range(self.gw.h):
-            for j in range(self.gw.w):
-                yield w_r, h_r, i, j
+        arrow_coords = lambda i,j: {0: ((j+0.3)*w_r, (i+0.5)*h_r),
+                                    1: ((j+0.7)*w_r, (i+0.5)*h_r),
+                                    2: ((j+0.5)*w_r, (i+0.3)*h_r),
+                                    3: ((j+0.5)*w_r, (i+0.7)*h_r)}
+        text_coords = lambda i,j: {0: ((j+0.25)*w_r, (i+0.5)*h_r),
+                                   1: ((j+0.75)*w_r, (i+0.5)*h_r),
+                                   2: ((j+0.5)*w_r, (i+0.25)*h_r),
+                                   3: ((j+0.5)*w_r, (i+0.75)*h_r)}
+
+        self.cell_rects = []
+        self.value_texts = []
+        self.reward_texts = []
+        self.arrows = []
+        for w_r, h_r, i, j in self.coords_generator():
+            self.cell_rects.append(self.cv.create_rectangle(
+                j*w_r, i*h_r, (j+1)*w_r, (i+1)*h_r, fill='white'))
+            self.value_texts.append(self.cv.create_text(
+                ((j+0.5)*w_r, (i+0.5)*h_r), text='',
+                font=('Arial', 20), tags='values', state='hidden'))
+            self.reward_texts.append([self.cv.create_text(
+                text_coords(i,j)[a], text='', font=('Arial', 15),
+                tags='rewards', state='hidden')
+                for a in range(self.gw.n_actions)])
+            self.arrows.append([self.cv.create_line(
+                ((j+0.5)*w_r, (i+0.5)*h_r), arrow_coords(i,j)[a],
+                arrow=tk.LAST, tags='policy', state='hidden')
+                for a in range(self.gw.n_actions)])
+
+        self.drawn_terminals = np.zeros(self.gw.n_states, dtype=bool)
+        self.update_terminals()
+
+    def switch_view(self, view):
+        # hide the items of every view, then redraw all the cells of the
+        # new one from scratch
+        self.drawn_view = view
+        self.drawn_version = -1
+        if not self.layout.show_text:
+            return
+        for tag in ('values', 'policy', 'rewards'):
+            self.cv.itemconfigure(tag, state='hidden')
+        self.drawn_values = None
+        self.drawn_policy = None
+        self.drawn_rewards = None
+        if view in ('values', 'rewards'):
+            self.cv.itemconfigure(view, state='normal')
+
+    def terminal_mask(self):
+        terminals = np.zeros(self.gw.n_states, dtype=bool)
+        terminals[list(self.gw.terminal_states)] = True
+        return terminals
+
+    def update_raster_view(self):
+        # render the current view into one image covering the canvas
+        terminals = self.terminal_mask()
+        if self.view == 'policy' and self.cur_policy is not None:
+            image = render_policy(self.layout, self.cur_policy, terminals)
+        elif self.view == 'rewards':
+            image = render_rewards(self.layout, self.cur_rewards, terminals)
+        else:
+            values = (np.zeros(self.gw.n_states) if self.cur_values is None
+                      else self.cur_values)
+            image = render_values(self.layout, values, terminals)
+
+        # the image has to stay referenced for Tk to keep showing it
+        self.photo = tk.PhotoImage(data=to_ppm(image), format='PPM')
+        self.cv.itemconfigure(self.image_item, image=self.photo)
+
+    def update_terminals(self):
+        terminals = self.terminal_mask()
+        for s in np.flatnonzero(terminals != self.drawn_terminals):
+            self.cv.itemconfigure(self.cell_rects[s],
+                                  fill='grey' if terminals[s] else 'white')
+        self.drawn_terminals = terminals
+
+    def changed_cells(self, new, old):
+        # non-terminal cells whose data differs between `new` and `old`
+        changed = np.ones(self.gw.n_states, dtype=bool) if old is None \
+                  else new != old
+        if changed.ndim > 1:
+            changed = changed.any(axis=1)
+        return np.flatnonzero(changed & ~self.drawn_terminals)
 
     def update_values_view(self, values):
         # TODO: colours
-        for w_r, h_r, i, j in self.coords_generator():
-            if i*self.gw.w+j in self.gw.terminal_states:
-                self.cv.create_rectangle(j*w_r, i*h_r,
-                                            (j+1)*w_r, (i+1)*h_r,
-                                            fill='grey')
-                continue
-
-            self.cv.create_rectangle(j*w_r, i*h_r,
-                                     (j+1)*w_r, (i+1)*h_r,
-                                     fill='white')
-            if self.cur_values is None:
-                continue
-
-            text = '{:.2f}'.format(self.cur_values[i*self.gw.w+j])
-            self.cv.create_text(((j+0.5)*w_r, (i+0.5)*h_r),
-                                text=text,
-                                font=('Arial', 20))
+        self.update_terminals()
+        if values is None:
+            return
 
-    def update_policy_view(self, policy):
-        end_coords = lambda i,j: {0: ((j+0.3)*w_r, (i+0.5)*h_r),
-                             1: ((j+0.7)*w_r, (i+0.5)*h_r),
-                             2: ((j+0.5)*w_r, (i+0.3)*h_r),
-                             3: ((j+0.5)*w_r, (i+0.7)*h_r)}
+        values = np.array(values)
+        for s in self.changed_cells(values, self.drawn_values):
+            self.cv.itemconfigure(self.value_texts[s],
+                                  text='{:.2f}'.format(values[s]))
+        self.drawn_values = values
 
+    def update_policy_view(self, policy):
+        self.update_terminals()
         if policy is None:
             return
-        
-        for w_r, h_r, i, j in self.coords_generator():
-            for a in policy[i*self.gw.w+j]:
-                if i*self.gw.w+j in self.gw.terminal_states:
-                    self.cv.create_rectangle(j*w_r, i*h_r,
-                                             (j+1)*w_r, (i+1)*h_r,
-                                             fill='grey')
-                    continue
-
-                self.cv.create_rectangle(j*w_r, i*h_r,
-                                         (j+1)*w_r, (i+1)*h_r,
-                                         fill='white')
-                self.cv.create_line(((j+0.5)*w_r, (i+0.5)*h_r),
-                                    end_coords(i,j)[a],
-                                    arrow = tk.LAST)
-
-    def update_rewards_view(self, policy):
-        text_coords = lambda i,j: {0: ((j+0.25)*w_r, (i+0.5)*h_r),
-                              1: ((j+0.75)*w_r, (i+0.5)*h_r),
-                              2: ((j+0.5)*w_r, (i+0.25)*h_r),
-                              3: ((j+0.5)*w_r, (i+0.75)*h_r)}
-        for w_r, h_r, i, j in self.coords_generator():
-            if i*self.gw.w+j in self.gw.terminal_states:
-                self.cv.create_rectangle(j*w_r, i*h_r,
-                                         (j+1)*w_r, (i+1)*h_r,
-                                         fill='grey')
-                continue
 
-            self.cv.create_rectangle(j*w_r, i*h_r,
-                                     (j+1)*w_r, (i+1)*h_r,
-                                     fill='white')
-
-            if self.cur_rewards is None:
-                continue
+        # arrows are drawn for the most likely actions of every state
+        best = policy == np.max(policy, axis=1, keepdims=True)
+        for s in self.changed_cells(best, self.drawn_policy):
+            for a in range(self.gw.n_actions):
+                self.cv.itemconfigure(self.arrows[s][a],
+                                      state='normal' if best[s,a]
+                                      else 'hidden')
+        self.drawn_policy = best
+
+    def update_rewards_view(self, rewards):
+        self.update_terminals()
+        if rewards is None:
+            return
 
+        rewards = np.array(rewards)
+        for s in self.changed_cells(rewards, self.drawn_rewards):
             for a in range(self.gw.n_actions):
-                text = '{:.2f}'.format(self.cur_rewards[i*self.gw.w+j,a])
-                self.cv.create_text(text_coords(i,j)[a],
-                                    text=text,
-                                    font=('Arial', 15))
+                self.cv.itemconfigure(self.reward_texts[s][a],
+                                      text='{:.2f}'.format(rewards[s,a]))
+        self.drawn_rewards = rewards
 
 class ValueIterationViewer(GridWorldViewer):
-    def __init__(self, gw):
-        super().__init__(gw)
-        self.values_iter = gw.mdp.value_iteration()
-        self.last_values = None
-
-    def get_values(self):
-        try:
-            values, _ = next(self.values_iter)
-        except StopIteration:
-            return self.last_values
-        else:
-            self.last_values = values
-            return values
-
-    def get_policy(self):
-        policy = []
-        for s in range(self.gw.n_states):
-            next_states = np.array([self.gw._next_state(a,s) for a in
-                                   range(self.gw.n_actions)])
-            q_s = np.take(self.last_values, next_states)
-            best_actions = np.argwhere(q_s == np.max(q_s)).reshape(-1)
-            policy.append(best_actions)
-        return policy
-
-    def get_rewards(self):
-        return self.gw.R
-
-    def __init__(self, gw):
-        super().__init__(gw)
-        self.values_iter = gw.mdp.value_iteration()
-        self.last_values = None
-
-    def get_values(self):
-        try:
-            values, _ = next(self.values_iter)
-        except StopIteration:
-            return self.last_values
-        else:
-            self.last_values = values
-            return values
-
-    def get_policy(self):
-        policy = []
-        for s in range(self.gw.n_states):
-            next_states = np.array([self.gw._next_state(a,s) for a in
-                                   range(self.gw.n_actions)])
-            q_s = np.take(self.last_values, next_states)
-            best_actions = np.argwhere(q_s == np.max(q_s)).reshape(-1)
-            policy.append(best_actions)
-        return policy
-
-    def get_rewards(self):
-        return self.gw.R
+    method = 'vi'
 
 class PolicyIterationViewer(GridWorldViewer):
-    def __init__(self, gw):
-        super().__init__(gw)
-        self.policy_iter = gw.mdp.policy_iteration()
-        self.last_values = None
-        self.last_policy = None
-
-    def get_values(self):
-        try:
-            values, policy, _ = next(self.policy_iter)
-        except StopIteration:
-            return self.last_values
-        else:
-            self.last_policy = policy
-            self.last_values = values
-            return values
-
-    def _transform_best_actions(self, policy):
-        # transform the probabilities of the policy yielded from the
-        # policy iteration call into a list of best action
-        transformed_policy = [
-            np.argwhere(policy[s] == np.max(policy[s])).reshape(-1)
-            for s in range(self.gw.n_states)
-        ]
-        return transformed_policy
-
-    def get_policy(self):
-        try:
-            values, policy, _ = next(self.policy_iter)
-        except StopIteration:
-            return self.last_policy
-        else:
-            policy = self._transform_best_actions(policy)
-            self.last_policy = policy
-            self.last_values = values
-            return policy
-
-    def get_rewards(self):
-        return self.gw.R
-
+    method = 'pi'